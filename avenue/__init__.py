@@ -1,12 +1,44 @@
-from . import envs
-from . import wrappers
+import importlib
+from functools import partial
 
+# Submodules are imported on first access (e.g. `avenue.wrappers`) so that `import avenue` stays cheap. Importing
+# `avenue.envs` pulls in gym, the ML-Agents stack is only imported when the first Unity instance is launched.
+_submodules = ("backends", "bench", "dataset", "env", "envs", "placement", "recording", "remote", "rpc", "stats",
+               "util", "vector", "wrappers")
 
-def make(env_name, **kwargs):
+
+def __getattr__(name):
+    if name in _submodules:
+        return importlib.import_module("." + name, __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def make(env_name, wrappers=(), **kwargs):
+    """`wrappers` are applied in order, e.g. `[partial(avenue.wrappers.Preprocess, key=0)]`"""
+    from . import envs
     env = getattr(envs, env_name.replace("-", "_"))(**kwargs)
+    for wrapper in wrappers:
+        env = wrapper(env)
     return env
 
 
+def make_vec(env_name, n, context="spawn", copy=True, auto_reset=True, placement=None, **kwargs):
+    """Creates `n` instances of `env_name` in separate worker processes (see `vector.VecAvenue`). `wrappers` (see
+    `make`) run in the workers, they need to be picklable.
+
+    `placement` pins each worker and its Unity process to its own cores, e.g. `dict(cores_per_env=4, threads=1,
+    nice=5)` (the arguments of `placement.plan`). The chosen layout is printed and kept in `placements`."""
+    from .vector import VecAvenue
+    from .placement import plan, report
+    placements = None
+    if placement is not None:
+        placements = plan(n, **placement)
+        print(f"Placing {n} {env_name} envs\n{report(placements)}", flush=True)
+    return VecAvenue([partial(make, env_name, **kwargs)] * n, context=context, copy=copy, auto_reset=auto_reset,
+                     placements=placements)
+
+
 def download(env_name):
+    from . import envs
     env_cls = getattr(envs, env_name.replace("-", "_"))  # this will only work for a subset of the envs specified via classes
     return env_cls.get_assets()
@@ -0,0 +1,183 @@
+import time
+
+import gym
+import numpy as np
+
+from .rpc import decoder
+
+"""
+Stand-ins for ML-Agents' gym UnityEnv (`mlagents.gym_unity.envs.unity_env.UnityEnv`), to be passed as `backend` to
+`UnityEnv` (or `avenue.make`). They produce the same `brain_info` as the simulator but need no Unity binary.
+`StubUnityEnv` generates observations, `ReplayUnityEnv` replays recorded ones.
+"""
+
+
+class BrainInfo:
+    """The parts of ML-Agents' BrainInfo that avenue uses"""
+    def __init__(self, visual_observations, vector_observations):
+        self.visual_observations = visual_observations  # list of float32 arrays of shape (1, height, width, 3) in [0, 1]
+        self.vector_observations = vector_observations  # array of shape (1, vector size)
+
+
+class StubUnityEnv(gym.Env):
+    """Produces random frames and a car driving along the track, at the resolution requested by the config.
+
+    `latency` (seconds) is added to every step, plus exponentially distributed noise with mean `jitter`, to mimic the
+    time the simulator takes.
+    """
+    needs_assets = False
+
+    def __init__(self, environment_filename=None, use_visual=True, worker_id=0, vector_state_class="AvenueCar",
+                 episode_length=1000, latency=0., jitter=0., seed=None):
+        self.use_visual = use_visual
+        self.decoder = decoder(vector_state_class)
+        self.episode_length = episode_length
+        self.latency = latency
+        self.jitter = jitter
+        self.rng = np.random.RandomState(seed)
+        self.action_space = gym.spaces.Box(-1, 1, (2,), np.float32)
+        self.width, self.height = 256, 64
+        self.t = 0
+
+    def configure(self, config):
+        self.width = config.get("width", self.width)
+        self.height = config.get("height", self.height)
+        self.observation_space = gym.spaces.Box(0, 1, (self.height, self.width, 3), np.float32)
+        self.frames = self.rng.rand(8, 1, self.height, self.width, 3).astype(np.float32)
+
+    def brain_info(self):
+        vec = np.zeros((1, self.decoder.size), np.float32)
+        s = self.decoder(vec[0])
+        s.velocity_magnitude[:] = self.rng.uniform(0, 20)
+        s.angle_to_next_waypoint_in_degrees[:] = self.rng.uniform(-30, 30)
+        s.steering_angle[:] = self.rng.uniform(-1, 1)
+        s.top_speed[:] = 26
+        s.current_waypoint[:] = self.t // 10
+        s.num_waypoints[:] = self.episode_length // 10 + 5
+        # ML-Agents decodes a new image every step so we return a copy
+        visual = [self.frames[self.t % len(self.frames)].copy()] if self.use_visual else []
+        return BrainInfo(visual, vec)
+
+    def reset_info(self, config=None):
+        if config is not None or not hasattr(self, "frames"):
+            self.configure(config or {})
+        self.t = 0
+        return self.brain_info()
+
+    def reset(self, config=None):
+        info = self.reset_info(config)
+        return info.visual_observations[0][0] if self.use_visual else info.vector_observations[0]
+
+    def step(self, action):
+        if self.latency or self.jitter:
+            time.sleep(self.latency + (self.rng.exponential(self.jitter) if self.jitter else 0))
+        self.t += 1
+        info = self.brain_info()
+        ob = info.visual_observations[0][0] if self.use_visual else info.vector_observations[0]
+        return ob, 0., False, dict(text_observation=None, brain_info=info)
+
+    def close(self):
+        pass
+
+
+class ReplayUnityEnv(gym.Env):
+    """Replays the episodes of a recording made with `avenue.wrappers.TrajectoryRecorder` (see `avenue.recording`),
+    memory-mapped, e.g. `avenue.make("RaceSolo-v0", backend=partial(ReplayUnityEnv, recording="rollouts/run1"))`.
+
+    Every reset starts the next episode (or a random one with `shuffle`), steps ignore the action and advance through
+    the recorded frames and vector states, repeating the last one at the end of the episode. Frames are served at the
+    recorded resolution, regardless of the config.
+    """
+    needs_assets = False
+
+    def __init__(self, environment_filename=None, use_visual=True, worker_id=0, recording=None, frame_field=None,
+                 state_field="state", shuffle=False, seed=None):
+        from .recording import Recording
+        assert recording is not None, "ReplayUnityEnv needs the path of a recording"
+        self.recording = rec = Recording(recording) if isinstance(recording, str) else recording
+        assert state_field in rec.fields, f"{recording} has no {state_field!r} field, its fields are {list(rec.fields)}"
+        if frame_field is None and use_visual:  # the first image field, e.g. "obs_0" or "obs_rgb"
+            frame_field = next(k for k, f in rec.fields.items() if len(f["shape"]) == 3 and f["dtype"] == "|u1")
+        self.frames = rec.field(frame_field) if use_visual else None
+        self.states = rec.field(state_field)
+        self.use_visual = use_visual
+        self.shuffle = shuffle
+        self.rng = np.random.RandomState(seed)
+        firsts = np.flatnonzero(np.concatenate(rec.field("first")))
+        self.episodes = list(zip(firsts, list(firsts[1:]) + [len(rec)]))
+        assert self.episodes, f"{recording} contains no episodes"
+        self.episode = -1
+        self.stepped = False
+        self.action_space = gym.spaces.Box(-1, 1, (2,), np.float32)
+        shape = tuple(rec.fields[frame_field]["shape"][:2]) + (3,) if use_visual else rec.fields[state_field]["shape"]
+        self.observation_space = gym.spaces.Box(0, 1, shape, np.float32)
+
+    def brain_info(self):
+        j, k = self.recording.locate(self.t)
+        vec = np.array(self.states[j][k], np.float32)[None]
+        if not self.use_visual:
+            return BrainInfo([], vec)
+        frame = self.frames[j][k]
+        visual = np.empty((1,) + frame.shape[:2] + (3,), np.float32)
+        np.multiply(frame, np.float32(1 / 255), out=visual[0])  # broadcasts gray frames to 3 channels
+        return BrainInfo([visual], vec)
+
+    def observe(self):
+        info = self.brain_info()
+        return info, info.visual_observations[0][0] if self.use_visual else info.vector_observations[0]
+
+    def reset_info(self, config=None):
+        if self.episode < 0 or self.stepped:  # don't skip episodes on back-to-back resets
+            n = len(self.episodes)
+            self.episode = self.rng.randint(n) if self.shuffle else (self.episode + 1) % n
+        self.t, self.end = self.episodes[self.episode]
+        self.stepped = False
+        return self.brain_info()
+
+    def reset(self, config=None):
+        info = self.reset_info(config)
+        return info.visual_observations[0][0] if self.use_visual else info.vector_observations[0]
+
+    def step(self, action):
+        self.stepped = True
+        self.t = min(self.t + 1, self.end - 1)
+        info, ob = self.observe()
+        return ob, 0., False, dict(text_observation=None, brain_info=info)
+
+    def close(self):
+        pass
+
+
+def test_replay_round_trip(lengths=(3, 1, 2)):
+    import tempfile
+    from functools import partial
+    import avenue
+    from .recording import ChunkWriter
+    rng = np.random.RandomState(0)
+    dec = decoder("AvenueCar")
+    path = tempfile.mkdtemp()
+    writer = ChunkWriter(path, chunk_size=4)  # episodes span chunks
+    frames, states = [], []
+    for length in lengths:
+        for t in range(length):
+            frames.append(rng.randint(0, 256, (8, 16, 3), np.uint8))
+            states.append(rng.rand(dec.size).astype(np.float32))
+            writer.append(dict(obs_0=frames[-1], state=states[-1], first=t == 0))
+    writer.close()
+
+    env = avenue.make("RaceSolo-v0", backend=partial(ReplayUnityEnv, recording=path))
+    try:
+        starts = np.cumsum((0,) + lengths)
+        for episode in list(range(len(lengths))) + [0]:  # wraps around to the first episode
+            ob = env.reset()
+            rows = list(range(starts[episode], starts[episode + 1]))
+            for i in rows + [rows[-1]]:  # the last frame is repeated at the end of the episode
+                assert np.array_equal(ob[0], frames[i]) and np.array_equal(ob[1][1:], states[i][dec.slices[
+                    dec.names.index("steering_angle")]])
+                ob, _, _, _ = env.step(env.action_space.sample())
+    finally:
+        env.close()
+
+
+if __name__ == "__main__":
+    test_replay_round_trip()
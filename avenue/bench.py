@@ -0,0 +1,240 @@
+import argparse
+import json
+import subprocess
+import sys
+import time
+from functools import partial
+
+import numpy as np
+
+"""
+Benchmarks, results are printed as json lines. Run `python -m avenue.bench --help`.
+"""
+
+HEAVY_MODULES = ("mlagents", "tensorflow", "gym", "gdown", "imageio")
+
+# heavy modules that importing each module is allowed to load, guarded by `test_import_is_lazy`
+IMPORT_ALLOWED = {
+    "avenue": (),
+    "avenue.util": (),
+    "avenue.rpc": (),
+    "avenue.placement": (),
+    "avenue.wrappers": ("gym",),
+    "avenue.envs": ("gym",),
+}
+
+_import_script = """
+import json, sys, time
+t0 = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - t0
+print(json.dumps(dict(seconds=seconds, loaded=[m for m in {heavy!r} if m in sys.modules])))
+"""
+
+
+def import_time(module="avenue", repeat=5):
+    """Time to import `module` in a fresh interpreter (best of `repeat`) and the heavy modules it loads"""
+    script = _import_script.format(module=module, heavy=HEAVY_MODULES)
+    runs = [json.loads(subprocess.check_output([sys.executable, "-c", script])) for _ in range(repeat)]
+    return dict(benchmark="import", module=module, seconds=min(r["seconds"] for r in runs), loaded=runs[0]["loaded"])
+
+
+def check_imports(repeat=1):
+    """Yields import_time results with an additional "ok" field that is False if a module loads too much"""
+    for module, allowed in IMPORT_ALLOWED.items():
+        r = import_time(module, repeat)
+        yield dict(r, ok=set(r["loaded"]) <= set(allowed))
+
+
+def test_import_is_lazy():
+    for r in check_imports():
+        assert r["ok"], f"import {r['module']} loads {r['loaded']}"
+
+
+def timings(fn, steps):
+    """Per call statistics of `fn()` in microseconds"""
+    fn()  # warm up
+    ts = np.empty(steps)
+    for i in range(steps):
+        t0 = time.perf_counter()
+        fn()
+        ts[i] = time.perf_counter() - t0
+    ts *= 1e6
+    return dict(n=steps, mean_us=ts.mean(), p50_us=np.percentile(ts, 50), p99_us=np.percentile(ts, 99), max_us=ts.max())
+
+
+def make_backend(name, latency=0., jitter=0., recording=None):
+    if name == "unity":
+        return None  # i.e. ML-Agents with the real binary
+    if name == "stub":
+        from .backends import StubUnityEnv
+        return partial(StubUnityEnv, latency=latency, jitter=jitter)
+    if name == "replay":
+        from .backends import ReplayUnityEnv
+        return partial(ReplayUnityEnv, recording=recording)
+    raise ValueError(f"Unknown backend {name}")
+
+
+def env_layers(env):
+    """All wrappers from `env` down to (and including) the UnityEnv"""
+    from .env import UnityEnv
+    layers = [env]
+    while not isinstance(layers[-1], UnityEnv):
+        layers.append(layers[-1].env)
+    return layers
+
+
+def bench_stages(env_name="RaceSolo-v0", backend="stub", steps=1000, latency=0., jitter=0., recording=None, **config):
+    """Cost of each stage of a step: the Unity round trip ("ipc"), decoding, rgb conversion, reward computation, every
+    wrapper in the `avenue.make` stack (as overhead over the layer below) and RandomizedEnv's reconfigurations (or env
+    swaps if the config needs a relaunch)"""
+    import avenue
+    from .wrappers import RandomizedEnv
+    env = avenue.make(env_name, backend=make_backend(backend, latency, jitter, recording), **config)
+    meta = dict(benchmark="stages", env=env_name, backend=backend, **config)
+    env.reset()
+    layers = env_layers(env)
+    unity = layers[-1]
+    action = unity.action_space.sample()
+    _, _, _, info = unity.env.step(action)
+    brain_info = info["brain_info"]
+
+    yield dict(meta, stage="ipc", **timings(lambda: unity.env.step(action), steps))
+    vec_obs, = brain_info.vector_observations
+    yield dict(meta, stage="decode", **timings(lambda: unity.decoder(vec_obs), steps))
+    yield dict(meta, stage="rgb", **timings(lambda: unity.to_rgb(brain_info.visual_observations[0]), steps))
+    s = unity.state
+    yield dict(meta, stage="reward", **timings(lambda: (unity.compute_reward(s, 0, False), unity.compute_terminal(
+        s, 0, False), unity.compute_reset(s, 0, False)), steps))
+    if hasattr(unity, "compute_reward_batch"):
+        batch = unity.decoder(np.repeat(vec_obs[None], 1024, axis=0))
+        r = timings(lambda: (unity.compute_reward_batch(batch), unity.compute_terminal_batch(batch),
+                             unity.compute_reset_batch(batch)), max(1, steps // 100))
+        yield dict(meta, stage="reward_batch_per_state", **{k: v / 1024 if k.endswith("_us") else v for k, v in r.items()})
+
+    inner_mean = None
+    for layer in reversed(layers):
+        r = timings(lambda: layer.step(action), steps)
+        overhead = None if inner_mean is None else r["mean_us"] - inner_mean
+        yield dict(meta, stage="layer", layer=type(layer).__name__, overhead_us=overhead, **r)
+        inner_mean = r["mean_us"]
+
+    for layer in layers:
+        if isinstance(layer, RandomizedEnv):
+            def swap():
+                layer.steps_since_config = layer.n + 1
+                layer.reset()
+            r = timings(swap, max(1, steps // 100))
+            yield dict(meta, stage="reconfig" if layer.reconfigs else "swap", layer=type(layer).__name__, **r)
+
+    env.close()
+
+
+def bench_batching(env_name="RaceSolo-v0", n=8, k=4, steps=200, latency=.01, jitter=.01, **config):
+    """Transitions per second of `n` stub envs with random step times, stepped in lockstep (every batch waits for the
+    slowest env) and in batches of the first `k` envs that are ready (see `VecAvenue.step_wait_first`)"""
+    import avenue
+    venv = avenue.make_vec(env_name, n, copy=False, backend=make_backend("stub", latency, jitter), **config)
+    meta = dict(benchmark="batching", env=env_name, n=n, latency=latency, jitter=jitter, **config)
+    try:
+        venv.reset()
+        actions = np.stack([venv.action_space.sample() for _ in range(n)])
+        t0 = time.perf_counter()
+        for _ in range(steps):
+            venv.step(actions)
+        yield dict(meta, mode="lockstep", batch=n, transitions_per_s=n * steps / (time.perf_counter() - t0))
+
+        venv.reset()
+        venv.step_async(actions)
+        batches = n * steps // k
+        t0 = time.perf_counter()
+        for _ in range(batches):
+            env_ids, *_ = venv.step_wait_first(k)
+            venv.step_async(actions[env_ids], env_ids)
+        yield dict(meta, mode="first_k", batch=k, transitions_per_s=k * batches / (time.perf_counter() - t0))
+    finally:
+        venv.close()
+
+
+def bench_memory(env_name="RaceSolo-v0", backend="stub", steps=1000, recording=None, **config):
+    """Bytes (allocated while stepping, measured with tracemalloc) retained per transition `(ob, reward, done, info)`
+    kept in a list, e.g. by a replay buffer, with and without `slim_info`. `obs_bytes` is the size of the observation
+    alone."""
+    import tracemalloc
+    import avenue
+    from .vector import obs_leaves
+    for slim_info in (False, True):
+        env = avenue.make(env_name, backend=make_backend(backend, recording=recording), slim_info=slim_info, **config)
+        env.reset()
+        action = env.action_space.sample()
+        transitions = []
+        tracemalloc.start()
+        for _ in range(steps):
+            ob, reward, done, info = env.step(action)
+            transitions.append((ob, reward, done, info))
+            if done:
+                env.reset()
+        retained = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        env.close()
+        yield dict(benchmark="memory", env=env_name, backend=backend, slim_info=slim_info, steps=steps,
+                   bytes_per_transition=retained / steps, obs_bytes=sum(x.nbytes for x in obs_leaves(ob)), **config)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog="python -m avenue.bench", description="Avenue benchmarks (json lines output)")
+    sub = parser.add_subparsers(dest="benchmark", required=True)
+    p = sub.add_parser("import", help="import time of avenue's modules, fails if heavy dependencies are loaded eagerly")
+    p.add_argument("--repeat", type=int, default=5)
+    p = sub.add_parser("stages", help="per stage cost of stepping an env")
+    p.add_argument("--env", default="RaceSolo-v0")
+    p.add_argument("--backend", choices=("stub", "replay", "unity"), default="stub")
+    p.add_argument("--recording", help="path of a recording for the replay backend (see avenue.recording)")
+    p.add_argument("--steps", type=int, default=1000)
+    p.add_argument("--width", type=int, default=256)
+    p.add_argument("--height", type=int, default=64)
+    p.add_argument("--latency", type=float, default=0., help="seconds added to every stub step")
+    p.add_argument("--jitter", type=float, default=0., help="mean of exponential noise added to every stub step")
+    p = sub.add_parser("batching", help="throughput of lockstep vs. first-k batching with stub envs of random latency")
+    p.add_argument("--env", default="RaceSolo-v0")
+    p.add_argument("-n", type=int, default=8, help="number of envs")
+    p.add_argument("-k", type=int, default=4, help="batch size of first-k batching")
+    p.add_argument("--steps", type=int, default=200, help="lockstep steps (first-k makes as many transitions)")
+    p.add_argument("--latency", type=float, default=.01, help="seconds added to every stub step")
+    p.add_argument("--jitter", type=float, default=.01, help="mean of exponential noise added to every stub step")
+    p.add_argument("--width", type=int, default=256)
+    p.add_argument("--height", type=int, default=64)
+    p = sub.add_parser("memory", help="memory retained per stored transition, with and without slim_info")
+    p.add_argument("--env", default="RaceSolo-v0")
+    p.add_argument("--backend", choices=("stub", "replay", "unity"), default="stub")
+    p.add_argument("--recording", help="path of a recording for the replay backend (see avenue.recording)")
+    p.add_argument("--steps", type=int, default=1000)
+    p.add_argument("--width", type=int, default=256)
+    p.add_argument("--height", type=int, default=64)
+    args = parser.parse_args(args)
+
+    if args.benchmark == "import":
+        ok = True
+        for r in check_imports(args.repeat):
+            print(json.dumps(r), flush=True)
+            ok &= r["ok"]
+        return 0 if ok else 1
+    if args.benchmark == "stages":
+        for r in bench_stages(args.env, args.backend, args.steps, args.latency, args.jitter, args.recording,
+                              width=args.width, height=args.height):
+            print(json.dumps(r), flush=True)
+    if args.benchmark == "batching":
+        for r in bench_batching(args.env, args.n, args.k, args.steps, args.latency, args.jitter, width=args.width,
+                                height=args.height):
+            print(json.dumps(r), flush=True)
+    if args.benchmark == "memory":
+        for r in bench_memory(args.env, args.backend, args.steps, args.recording, width=args.width, height=args.height):
+            print(json.dumps(r), flush=True)
+    return 0
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["test"]:  # python -m avenue.bench test
+        test_import_is_lazy()
+    else:
+        sys.exit(main())
@@ -0,0 +1,172 @@
+import argparse
+import importlib
+import json
+import os
+import shutil
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+
+import numpy as np
+
+from .recording import Recording, read_meta, write_json
+
+"""
+Offline datasets: `avenue-dataset OUT --env RaceSolo-v0 --shards 100 --shard-size 10000 --workers 8` rolls out a policy
+in a pool of worker processes, each shard in its own env with a distinct `city_seed` and `weather_condition`, e.g.
+
+    OUT/index.json              {"env": ..., "fields": {...}, "shards": [{"name": "shard_000000", "length": 10000,
+                                 "episodes": 12, "config": {"city_seed": 4242, "weather_condition": 0}}, ...]}
+    OUT/shard_000000/           a recording (see `avenue.recording`) of `shard_size` transitions
+    ...
+
+Shards are written to `shard_NNNNNN.tmp` and renamed when complete. Running the same command again skips the complete
+shards and regenerates the others, so a crashed run resumes where it stopped. `Dataset(OUT)` gives memory-mapped random
+access to all transitions.
+"""
+
+WEATHER_CONDITIONS = 5  # see the config table in avenue/envs.py
+
+
+def shard_configs(num_shards, seed=0):
+    """Distinct city seeds and cycling weather conditions, the same for every run with the same `seed`"""
+    if num_shards > 10001:
+        raise ValueError(f"There are only 10001 city seeds, can't make {num_shards} distinct shards")
+    city_seeds = np.random.RandomState(seed).permutation(10001)[:num_shards]
+    return [dict(city_seed=int(s), weather_condition=i % WEATHER_CONDITIONS) for i, s in enumerate(city_seeds)]
+
+
+def random_policy(env):
+    return lambda ob: env.action_space.sample()
+
+
+def load_policy(spec):
+    """"module:attribute", a callable that gets the env and returns a policy, i.e. a function from observations to
+    actions (e.g. loading a checkpoint)"""
+    module, _, attribute = spec.partition(":")
+    return getattr(importlib.import_module(module), attribute)
+
+
+def generate_shard(path, env_name, config, shard_size, policy="avenue.dataset:random_policy", env_kwargs=None):
+    """Records `shard_size` transitions to `path`, returns the number of episodes"""
+    import avenue
+    from .wrappers import TrajectoryRecorder
+    tmp = path + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    env = TrajectoryRecorder(avenue.make(env_name, **dict(env_kwargs or {}, **config)), tmp)
+    try:
+        act = load_policy(policy)(env)
+        ob, rows, episodes = env.reset(), 1, 1
+        while rows < shard_size:
+            ob, _, done, _ = env.step(act(ob))
+            rows += 1
+            if done and rows < shard_size:
+                ob, rows, episodes = env.reset(), rows + 1, episodes + 1
+    finally:
+        env.close()
+    os.replace(tmp, path)
+    return episodes
+
+
+def write_index(path, env_name, shards):
+    """`shards` maps names to their entries, only complete shards are listed"""
+    entries = [shards[name] for name in sorted(shards)]
+    fields = read_meta(os.path.join(path, entries[0]["name"]))["fields"] if entries else {}
+    write_json(os.path.join(path, "index.json"), dict(env=env_name, fields=fields, shards=entries))
+
+
+def generate(path, env_name="RaceSolo-v0", num_shards=10, shard_size=10000, workers=4, seed=0,
+             policy="avenue.dataset:random_policy", **env_kwargs):
+    os.makedirs(path, exist_ok=True)
+    index_path = os.path.join(path, "index.json")
+    shards = {}
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            shards = {s["name"]: s for s in json.load(f)["shards"]}
+    for name in os.listdir(path):
+        if name.endswith(".tmp"):  # incomplete shards from a previous run
+            shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+    todo = []
+    for i, config in enumerate(shard_configs(num_shards, seed)):
+        name = f"shard_{i:06d}"
+        if name in shards and os.path.isdir(os.path.join(path, name)):
+            continue
+        if os.path.isdir(os.path.join(path, name)):  # complete but not yet in the index
+            episodes = int(np.concatenate(Recording(os.path.join(path, name)).field("first")).sum())
+            shards[name] = dict(name=name, length=shard_size, episodes=episodes, config=config)
+            continue
+        shards.pop(name, None)
+        todo.append((name, config))
+    write_index(path, env_name, shards)
+    print(f"{len(shards)} of {num_shards} shards complete, generating {len(todo)} with {workers} workers", flush=True)
+
+    with ProcessPoolExecutor(workers, get_context("spawn")) as pool:
+        futures = {pool.submit(generate_shard, os.path.join(path, name), env_name, config, shard_size, policy,
+                               env_kwargs): (name, config) for name, config in todo}
+        for future in as_completed(futures):
+            name, config = futures[future]
+            shards[name] = dict(name=name, length=shard_size, episodes=future.result(), config=config)
+            write_index(path, env_name, shards)
+            print(f"{name} done ({len(shards)}/{num_shards})", flush=True)
+
+
+class Dataset:
+    """Memory-mapped random access to the transitions of all shards, `dataset[i]` is a dict of arrays (see
+    `TrajectoryRecorder` for the fields)"""
+    def __init__(self, path):
+        with open(os.path.join(path, "index.json")) as f:
+            self.index = json.load(f)
+        self.fields = self.index["fields"]
+        self.shards = [Recording(os.path.join(path, s["name"])) for s in self.index["shards"]]
+        self.offsets = np.cumsum([0] + [len(r) for r in self.shards])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, i):
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        j = int(np.searchsorted(self.offsets, i, side="right")) - 1
+        return self.shards[j][i - int(self.offsets[j])]
+
+
+def main(args=None):
+    from .bench import make_backend
+    parser = argparse.ArgumentParser(prog="avenue-dataset", description="Generates a sharded offline dataset")
+    parser.add_argument("path")
+    parser.add_argument("--env", default="RaceSolo-v0")
+    parser.add_argument("--shards", type=int, default=10)
+    parser.add_argument("--shard-size", type=int, default=10000, help="transitions per shard")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0, help="determines the configs of the shards")
+    parser.add_argument("--policy", default="avenue.dataset:random_policy",
+                        help="module:attribute of a function that gets the env and returns a policy")
+    parser.add_argument("--backend", choices=("unity", "stub", "replay"), default="unity")
+    parser.add_argument("--recording", help="path of a recording for the replay backend (see avenue.recording)")
+    parser.add_argument("--config", action="append", default=[], metavar="KEY=VALUE",
+                        help="config overrides (values are parsed as json), e.g. --config width=128")
+    args = parser.parse_args(args)
+    config = {k: json.loads(v) for k, v in (c.split("=", 1) for c in args.config)}
+    generate(args.path, args.env, args.shards, args.shard_size, args.workers, args.seed, args.policy,
+             backend=make_backend(args.backend, recording=args.recording), **config)
+    return 0
+
+
+def test_shard_configs(num_shards=12):
+    configs = shard_configs(num_shards)
+    assert configs == shard_configs(num_shards) != shard_configs(num_shards, seed=1)
+    assert len({c["city_seed"] for c in configs}) == num_shards
+    assert [c["weather_condition"] for c in configs[:WEATHER_CONDITIONS + 1]] == list(range(WEATHER_CONDITIONS)) + [0]
+    assert len(shard_configs(10001)) == 10001
+    try:
+        shard_configs(10002)
+        assert False, "expected a ValueError"
+    except ValueError:
+        pass
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["test"]:  # python -m avenue.dataset test
+        test_shard_configs()
+    else:
+        sys.exit(main())
@@ -1,6 +1,5 @@
 from functools import partial
-
-from gym.wrappers import TimeLimit
+from inspect import signature
 
 from .env import *
 from .wrappers import *
@@ -33,89 +32,170 @@ class Car_v0(BaseAvenue):
 
     _top_speed = 50
 
-    def __init__(self, config):
-        defaults = dict(task=0, skip_frame=4, hd_rendering=0)
-        super().__init__(config=dict(defaults, **config))
+    config_defaults = dict(task=0, skip_frame=4, hd_rendering=0)
+
+    def __init__(self, config, **kwargs):
+        super().__init__(config=config, **kwargs)
+
+    def make_config(self, config):
+        return super().make_config(dict(self.config_defaults, **(config or {})))
 
     def reset(self, **kwargs):
         ob = super().reset(**kwargs)
         ob["velocity_magnitude"] = ob["velocity_magnitude"] / self._top_speed
         return ob
 
-    def step(self, action):
-        ob, reward, done, info = super().step(action)
+    def step_wait(self):
+        ob, reward, done, info = super().step_wait()
         ob["velocity_magnitude"] = ob["velocity_magnitude"] / self._top_speed
 
-        info["reset"] = self.compute_reset(ob, reward, done)
+        info["reset"] = self.compute_reset(self.state, reward, done) or info.get("relaunched", False)
         done = done or info["reset"]
 
         return ob, reward, done, info
 
-    def compute_reward(self, s, r, d):
-        theta = math.radians(s.angle_to_next_waypoint_in_degrees[0])
-        velocity_magnitude = s.velocity_magnitude[0] / self._top_speed  # 50 m/s = 180km/h is the max speed
-
-        normalized_forward_velocity = math.cos(theta) * velocity_magnitude  # in [0, 1]
-
+    # The reward is computed from the helpers below both for single states (in compute_reward, where only the branch
+    # that is taken is evaluated) and for batches (in compute_reward_batch). Since both apply the same numpy operations
+    # the results are bit-identical. They compute in the dtype the original scalar formula promotes the state to (see
+    # `_dtype`), the cosine of the angle in float64. Squares are x * x, because `x**2` on numpy scalars calls pow(),
+    # which can be one ulp off the correctly rounded square that the array path gives.
+
+    @classmethod
+    def _dtype(cls, s):
+        """float64 with numpy 1 (a numpy scalar divided by a python number), the dtype of the state with numpy 2"""
+        return (s.velocity_magnitude.dtype.type(1) / cls._top_speed).dtype
+
+    @classmethod
+    def _hits(cls, s):
+        """Collision flags and their reward coefficients, in order of priority"""
+        return ((s.collide_pedestrian, cls.reward_pedestrian_hit),
+                (s.collide_car, cls.reward_car_hit),
+                (s.collide_other, cls.reward_obstacle_hit),
+                (s.ground_col, cls.reward_ground_col))
+
+    @classmethod
+    def _hit_reward(cls, coefficient, velocity_magnitude):
         # velocity squared is proportional to kinetic energy
         # we want to minimize the car's energy if it goes off the road or hits something
+        return coefficient * (velocity_magnitude * velocity_magnitude)
+
+    @classmethod
+    def _close_reward(cls, velocity_magnitude):
+        # when close then target speed = 2 m/s
+        d = velocity_magnitude - 0.04
+        return cls.reward_close_pedestrian_car * (d * d)  # in [-1, 0]
+
+    @classmethod
+    def _driving_reward(cls, angle_to_next_waypoint_in_degrees, velocity_magnitude):
+        theta = np.radians(angle_to_next_waypoint_in_degrees.astype(np.float64))
+        normalized_forward_velocity = np.cos(theta).astype(velocity_magnitude.dtype) * velocity_magnitude  # in [0, 1]
+
+        # general target speed = 12.5 m/s = 45km/h
+        # v = 0     ->  0
+        # v = tgt   ->  1
+        # v = max   -> -8
+        normalized_target_speed = cls.target_velocity / cls._top_speed
+        d = normalized_forward_velocity/normalized_target_speed - 1
+        return 1 - d * d
 
-        if s.collide_pedestrian[0]:
-            r = self.reward_pedestrian_hit * velocity_magnitude**2
-        elif s.collide_car[0]:
-            r = self.reward_car_hit * velocity_magnitude**2
-        elif s.collide_other[0]:
-            r = self.reward_obstacle_hit * velocity_magnitude**2
-        elif s.ground_col[0]:
-            r = self.reward_ground_col * velocity_magnitude**2
-        elif s.close_car[0] or s.close_pedestrian[0]:
-            # when close then target speed = 2 m/s
-            r = self.reward_close_pedestrian_car * (velocity_magnitude - 0.04)**2  # in [-1, 0]
-        else:
-            # general target speed = 12.5 m/s = 45km/h
-            # v = 0     ->  0
-            # v = tgt   ->  1
-            # v = max   -> -8
-            normalized_target_speed = self.target_velocity / self._top_speed
-            r = 1 - (normalized_forward_velocity/normalized_target_speed - 1)**2
-
-        return r  # approx. in [-10, 1]
+    def compute_reward(self, s, r, d):
+        # 50 m/s = 180km/h is the max speed
+        velocity_magnitude = s.velocity_magnitude[0].astype(self._dtype(s)) / self._top_speed
+        for flag, coefficient in self._hits(s):
+            if flag[0]:
+                return self._hit_reward(coefficient, velocity_magnitude)
+        if s.close_car[0] or s.close_pedestrian[0]:
+            return self._close_reward(velocity_magnitude)
+        # approx. in [-10, 1]
+        return self._driving_reward(s.angle_to_next_waypoint_in_degrees[0], velocity_magnitude)
 
     def compute_terminal(self, s, r, d):
-        return any((
+        return bool(any((
             s.collide_other[0],
             s.collide_car[0],
             s.collide_pedestrian[0],
             s.ground_col[0],
-        ))
+        )))
 
     def compute_reset(self, s, r, d):
-        return s["current_waypoint"][0] > (s["num_waypoints"][0] - 5)
+        return bool(s.current_waypoint[0] > (s.num_waypoints[0] - 5))
+
+    # The batch versions take states whose fields are (N, size) columns, e.g. `rpc.decoder("AvenueCar")(block)` for a
+    # block of N vector observations, and return arrays of shape (N,).
+
+    @classmethod
+    def compute_reward_batch(cls, s):
+        velocity_magnitude = s.velocity_magnitude[..., 0].astype(cls._dtype(s)) / cls._top_speed
+        r = cls._driving_reward(s.angle_to_next_waypoint_in_degrees[..., 0], velocity_magnitude)
+        close = (s.close_car[..., 0] != 0) | (s.close_pedestrian[..., 0] != 0)
+        r = np.where(close, cls._close_reward(velocity_magnitude), r)
+        for flag, coefficient in reversed(cls._hits(s)):  # reversed, so that the first flag that is set decides
+            r = np.where(flag[..., 0] != 0, cls._hit_reward(coefficient, velocity_magnitude), r)
+        return r
 
+    @classmethod
+    def compute_terminal_batch(cls, s):
+        return ((s.collide_other[..., 0] != 0) | (s.collide_car[..., 0] != 0) |
+                (s.collide_pedestrian[..., 0] != 0) | (s.ground_col[..., 0] != 0))
 
-def make_env(conf, concat_complex=False, record_video=False):
+    @classmethod
+    def compute_reset_batch(cls, s):
+        return s.current_waypoint[..., 0] > (s.num_waypoints[..., 0] - 5)
 
+
+def make_env(conf, concat_complex=False, record_video=False, prefetch=0, step_timeout=None, backend=None, gray=False,
+             visual=True, render_every=1, video_dir=None, video_format="mp4", video_size=(1920, 1024),
+             reuse_buffers=False, slim_info=False, placement=None, reset_timeout=None):
+    """With `visual=False` the observation only contains the vector (see BaseAvenue for the other options). With
+    `reuse_buffers` observations are only valid until the next step. With `slim_info` the info dict doesn't hold
+    ML-Agents' BrainInfo and avenue_state is a flat vector.
+
+    `placement` pins the Unity process to cores, e.g. `dict(cores=[0, 1], threads=1, nice=5)` (see avenue.placement).
+
+    With `record_video` every episode is saved to `video_dir` (see VideoSaver), rendered at `video_size` (or at the
+    observation size if `video_size` is None) and without skipping frames.
+
+    `conf` is a config or a function returning a new (e.g. randomized) config every time it is called, which is done
+    every 10000 steps (see RandomizedEnv)."""
+
+    config_fn = conf if callable(conf) else partial(dict, conf)
     if record_video:
-        raise NotImplementedError()
-        # generate_env = partial(generate_env, skip_frame=0, hd_rendering=1, hd_rendering_width=1920,
-        #                        hd_rendering_height=1024)
+        assert visual, "record_video needs visual observations"
+        overrides = dict(skip_frame=0)
+        if video_size is not None:
+            overrides.update(hd_rendering=1, hd_rendering_width=video_size[0], hd_rendering_height=video_size[1])
+        config_fn = partial(sample_config, config_fn, overrides)
 
-    else:
-        generate_env = partial(Car_v0, conf)
+    generate_env = partial(Car_v0, step_timeout=step_timeout, backend=backend, gray=gray, visual=visual,
+                           render_every=render_every, reuse_buffers=reuse_buffers, slim_info=slim_info,
+                           placement=placement, reset_timeout=reset_timeout)
 
-    env = RandomizedEnv(generate_env, n=10000)
+    env = RandomizedEnv(generate_env, n=10000, prefetch=prefetch, config_fn=config_fn)
     env = TimeLimit(env, max_episode_steps=1000)
 
     if record_video:
-        env = VideoSaver(env)
+        env = VideoSaver(env, video_dir, video_format)
 
     if concat_complex:
-        env = ConcatComplex(env, {"rgb": ["rgb"], "vector": ["velocity_magnitude", "steering_angle"]})
+        env = ConcatComplex(env, dict({"rgb": ["rgb"]} if visual else {}, vector=["velocity_magnitude", "steering_angle"]),
+                            reuse_buffers=reuse_buffers)
     else:
-        env = DictToTupleWrapper(env, "rgb", ["velocity_magnitude", "steering_angle"])
+        env = DictToTupleWrapper(env, *(["rgb"] if visual else []), ["velocity_magnitude", "steering_angle"],
+                                 reuse_buffers=reuse_buffers)
     return env
 
 
+def sample_config(config_fn, overrides):
+    return dict(config_fn(), **overrides)
+
+
+def make_env_from_defaults(defaults, kwargs):
+    """Keyword arguments that are parameters of `make_env` are passed on to it, all others override the configs returned
+    by `defaults()`, which is called again for every reconfiguration"""
+    options = {k: kwargs.pop(k) for k in list(kwargs) if k in signature(make_env).parameters and k != "conf"}
+    return make_env(partial(sample_config, defaults, kwargs), **options)
+
+
 """
 |weather_condition | Control the weather with predefined settings. | [0 - 4] | <ul> <li>0: Clear day</li> <li>1: Light rain</li><li>2:Heavy rain</li> <li>3: Light snow</li> <li>4: Storm </li> </ul> |
 |lane_number| Number of lanes. | [1- 12]||
@@ -132,8 +212,8 @@ def make_env(conf, concat_complex=False, record_video=False):
 """
 
 
-def RaceSolo_v0(**kwargs):
-    defaults = dict(
+def race_solo_defaults():
+    return dict(
             lane_number=2,
             task=0,
             time=random.randint(8, 17),
@@ -152,11 +232,14 @@ def RaceSolo_v0(**kwargs):
             done_unity=1,
             starting_speed=random.randint(0, 10),
         )
-    return make_env(dict(defaults, **kwargs))
 
 
-def RaceObstacles_v0(**kwargs):
-    defaults = dict(
+def RaceSolo_v0(**kwargs):
+    return make_env_from_defaults(race_solo_defaults, kwargs)
+
+
+def race_obstacles_defaults():
+    return dict(
         lane_number=2,
         task=0,
         time=random.randint(8, 17),
@@ -177,11 +260,13 @@ def RaceObstacles_v0(**kwargs):
         nb_obstacles=200
     )
 
-    return make_env(dict(defaults, **kwargs))
 
+def RaceObstacles_v0(**kwargs):
+    return make_env_from_defaults(race_obstacles_defaults, kwargs)
 
-def CityPedestrians_v0(**kwargs):
-    defaults = dict(
+
+def city_pedestrians_defaults():
+    return dict(
         lane_number=2,
         road_length=700,
         task=0,
@@ -203,11 +288,13 @@ def CityPedestrians_v0(**kwargs):
         nb_obstacles=0
     )
 
-    return make_env(dict(defaults, **kwargs))
 
+def CityPedestrians_v0(**kwargs):
+    return make_env_from_defaults(city_pedestrians_defaults, kwargs)
 
-def CityCars_v0(**kwargs):
-    defaults = dict(
+
+def city_cars_defaults():
+    return dict(
         lane_number=2,
         road_length=700,
         task=0,
@@ -229,4 +316,82 @@ def CityCars_v0(**kwargs):
         nb_obstacles=0
     )
 
-    return make_env(dict(defaults, **kwargs))
+
+def CityCars_v0(**kwargs):
+    return make_env_from_defaults(city_cars_defaults, kwargs)
+
+
+def legacy_compute_reward(s):
+    """The original scalar reward, verbatim, to test against"""
+    theta = math.radians(s.angle_to_next_waypoint_in_degrees[0])
+    velocity_magnitude = s.velocity_magnitude[0] / Car_v0._top_speed  # 50 m/s = 180km/h is the max speed
+
+    normalized_forward_velocity = math.cos(theta) * velocity_magnitude  # in [0, 1]
+
+    if s.collide_pedestrian[0]:
+        r = Car_v0.reward_pedestrian_hit * velocity_magnitude**2
+    elif s.collide_car[0]:
+        r = Car_v0.reward_car_hit * velocity_magnitude**2
+    elif s.collide_other[0]:
+        r = Car_v0.reward_obstacle_hit * velocity_magnitude**2
+    elif s.ground_col[0]:
+        r = Car_v0.reward_ground_col * velocity_magnitude**2
+    elif s.close_car[0] or s.close_pedestrian[0]:
+        r = Car_v0.reward_close_pedestrian_car * (velocity_magnitude - 0.04)**2  # in [-1, 0]
+    else:
+        normalized_target_speed = Car_v0.target_velocity / Car_v0._top_speed
+        r = 1 - (normalized_forward_velocity/normalized_target_speed - 1)**2
+
+    return r  # approx. in [-10, 1]
+
+
+def pow_squares_exactly(s):
+    """Whether the `x**2` the original formula takes for `s` is the correctly rounded square. It is libm's pow (or powf
+    for float32 with numpy 2), which is one ulp off for about 0.1% of the inputs."""
+    velocity_magnitude = s.velocity_magnitude[0] / Car_v0._top_speed
+    if any(flag[0] for flag, _ in Car_v0._hits(s)):
+        x = velocity_magnitude
+    elif s.close_car[0] or s.close_pedestrian[0]:
+        x = velocity_magnitude - 0.04
+    else:
+        theta = math.radians(s.angle_to_next_waypoint_in_degrees[0])
+        x = math.cos(theta) * velocity_magnitude/(Car_v0.target_velocity / Car_v0._top_speed) - 1
+    return x**2 == x * x
+
+
+def test_car_v0_batch(n=10000):
+    from .backends import StubUnityEnv
+    rng = np.random.RandomState(0)
+    dec = decoder(Car_v0.vector_state_class)
+    block = rng.uniform(-100, 100, (n, dec.size))
+    for name in ("collide_pedestrian", "collide_car", "collide_other", "ground_col", "close_car", "close_pedestrian"):
+        block[:, dec.slices[dec.names.index(name)]] = rng.rand(n, 1) < 0.1
+    block[:, dec.slices[dec.names.index("num_waypoints")]] = rng.randint(5, 50, (n, 1))
+    block[:, dec.slices[dec.names.index("current_waypoint")]] = rng.randint(0, 50, (n, 1))
+    car = Car_v0({}, backend=StubUnityEnv)
+    try:
+        for dtype in (np.float32, np.float64):  # float32 states as Unity sends them, float64 as numpy 1 promotes them
+            states = dec(block, np.empty(block.shape, dtype))
+            rewards = Car_v0.compute_reward_batch(states)
+            terminals = Car_v0.compute_terminal_batch(states)
+            resets = Car_v0.compute_reset_batch(states)
+            checked = 0
+            for i, row in enumerate(block):
+                s = dec(row, np.empty(row.shape, dtype))
+                original = legacy_compute_reward(s)
+                reward = car.compute_reward(s, 0, False)
+                assert reward == rewards[i] and reward.dtype == rewards.dtype == np.asarray(original).dtype, i
+                if pow_squares_exactly(s):
+                    assert reward == original, i
+                    checked += 1
+                assert car.compute_terminal(s, 0, False) == terminals[i] == any((
+                    s.collide_other[0], s.collide_car[0], s.collide_pedestrian[0], s.ground_col[0])), i
+                legacy_reset = s.current_waypoint[0] > (s.num_waypoints[0] - 5)
+                assert car.compute_reset(s, 0, False) == resets[i] == legacy_reset, i
+            assert checked > n * 0.99
+            assert terminals.any() and not terminals.all() and resets.any() and not resets.all()
+    finally:
+        car.close()
+
+if __name__ == "__main__":
+    test_car_v0_batch()
@@ -0,0 +1,165 @@
+import argparse
+import contextlib
+import glob
+import json
+import os
+import sys
+import threading
+
+"""
+Placement of Unity instances and the Python processes stepping them on many-core (NUMA) hosts: CPU pinning, thread
+count limits and nice levels.
+
+A placement is a dict `dict(cores=[...], threads=1, nice=5)` (all optional). Children inherit the CPU affinity, nice
+level and environment of the thread that starts them, so applying a placement before Unity is launched places the
+simulator (including its render and job threads) too. `threads` sets the thread pool sizes of OpenMP, BLAS etc. (see
+`THREAD_VARS`) in the environment a process is started with, since the libraries read them once when they are loaded.
+
+`plan(n)` assigns each of `n` envs its own group of cores, keeping each group on one NUMA node and spreading the envs
+evenly over the nodes, e.g. `avenue.make_vec("RaceSolo-v0", 16, placement=dict(cores_per_env=4, threads=1))`.
+`avenue.make(..., placement=dict(cores=[0, 1]))` places a single env's Unity process without affecting the caller.
+Run `python -m avenue.placement -n 16` to see the layout that would be chosen.
+"""
+
+THREAD_VARS = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "NUMEXPR_NUM_THREADS",
+               "VECLIB_MAXIMUM_THREADS", "TF_NUM_INTRAOP_THREADS", "TF_NUM_INTEROP_THREADS")
+
+_environ_lock = threading.Lock()
+
+
+def parse_cpulist(s):
+    """"0-3,8,10-11" to [0, 1, 2, 3, 8, 10, 11]"""
+    cpus = []
+    for part in s.strip().split(","):
+        if part:
+            first, _, last = part.partition("-")
+            cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def format_cpulist(cpus):
+    """Inverse of `parse_cpulist`"""
+    ranges, cpus = [], sorted(cpus)
+    for c in cpus:
+        if ranges and c == ranges[-1][1] + 1:
+            ranges[-1][1] = c
+        else:
+            ranges.append([c, c])
+    return ",".join(str(a) if a == b else f"{a}-{b}" for a, b in ranges)
+
+
+def available_cpus():
+    return sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
+
+
+def numa_nodes():
+    """{node: [cpus]} of the CPUs this process may run on, a single node 0 if there is no NUMA information"""
+    available = set(available_cpus())
+    nodes = {}
+    for path in glob.glob("/sys/devices/system/node/node[0-9]*/cpulist"):
+        node = int(os.path.basename(os.path.dirname(path))[len("node"):])
+        with open(path) as f:
+            cpus = [c for c in parse_cpulist(f.read()) if c in available]
+        if cpus:
+            nodes[node] = cpus
+    return dict(sorted(nodes.items())) or {0: sorted(available)}
+
+
+def plan(n, cores_per_env=None, numa=True, threads=None, nice=None):
+    """Placements for `n` envs. Each env gets `cores_per_env` cores (by default as many as there are for all envs to get
+    the same number) within one NUMA node (unless `numa=False`), consecutive envs go to different nodes. If there are
+    fewer groups than envs the groups are shared round robin."""
+    nodes = numa_nodes() if numa else {0: available_cpus()}
+    if cores_per_env is None:
+        cores_per_env = max(1, min(len(cpus) for cpus in nodes.values()) * len(nodes) // max(n, 1))
+    per_node = {}
+    for node, cpus in nodes.items():
+        k = min(cores_per_env, len(cpus))  # nodes with fewer cores are shared by their envs
+        per_node[node] = [cpus[i:i + k] for i in range(0, len(cpus) - k + 1, k)]
+    rounds = max(map(len, per_node.values()))
+    groups = [(node, g[i]) for i in range(rounds) for node, g in per_node.items() if i < len(g)]
+    return [dict(node=node, cores=cores, threads=threads, nice=nice)
+            for node, cores in (groups[i % len(groups)] for i in range(n))]
+
+
+def describe(placement):
+    """e.g. "node 1, cores 8-11, threads 1, nice 5" """
+    parts = [] if placement.get("node") is None else [f"node {placement['node']}"]
+    if placement.get("cores"):
+        parts.append(f"cores {format_cpulist(placement['cores'])}")
+    parts += [f"{k} {placement[k]}" for k in ("threads", "nice") if placement.get(k) is not None]
+    return ", ".join(parts) or "unplaced"
+
+
+def report(placements):
+    return "\n".join(f"env {i}: {describe(p)}" for i, p in enumerate(placements))
+
+
+def apply(cores=None, threads=None, nice=None, node=None):
+    """Places the calling thread (and the processes and threads it starts from now on) and sets the thread count
+    variables in the environment of this process. Libraries that are already loaded (e.g. numpy's BLAS) don't pick them
+    up, use `thread_environ` around starting a process instead. `node` is informational (see `plan`)."""
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    if threads is not None:
+        os.environ.update({v: str(threads) for v in THREAD_VARS})
+    if nice:
+        os.nice(nice)
+
+
+@contextlib.contextmanager
+def thread_environ(threads):
+    """Sets the thread count variables (unless `threads` is None) while in the context, e.g. around starting a process
+    that inherits them, and restores them afterwards"""
+    with _environ_lock:
+        saved = {v: os.environ.get(v) for v in THREAD_VARS}
+        if threads is not None:
+            os.environ.update({v: str(threads) for v in THREAD_VARS})
+        try:
+            yield
+        finally:
+            for v, value in saved.items():
+                if value is None:
+                    os.environ.pop(v, None)
+                else:
+                    os.environ[v] = value
+
+
+def run_placed(fn, cores=None, threads=None, nice=None, node=None):
+    """Calls `fn()` in a new thread with the placement applied and returns its result, i.e. processes started by `fn`
+    (e.g. Unity) are placed but the caller isn't. The thread count variables are only set while `fn` runs."""
+    result = {}
+
+    def target():
+        try:
+            apply(cores, None, nice)
+            result["value"] = fn()
+        except BaseException as e:
+            result["error"] = e
+
+    with thread_environ(threads):
+        thread = threading.Thread(target=target, daemon=True)
+        thread.start()
+        thread.join()
+    if "error" in result:
+        raise result["error"]
+    return result["value"]
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog="python -m avenue.placement", description="Shows the placement of n envs")
+    parser.add_argument("-n", type=int, default=os.cpu_count())
+    parser.add_argument("--cores-per-env", type=int)
+    parser.add_argument("--no-numa", action="store_true", help="ignore NUMA nodes")
+    parser.add_argument("--threads", type=int)
+    parser.add_argument("--nice", type=int)
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args(args)
+    placements = plan(args.n, args.cores_per_env, not args.no_numa, args.threads, args.nice)
+    print("NUMA nodes: " + ", ".join(f"{k}: {format_cpulist(v)}" for k, v in numa_nodes().items()))
+    print(json.dumps(placements) if args.json else report(placements))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
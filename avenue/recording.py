@@ -0,0 +1,306 @@
+import json
+import os
+import queue
+import shutil
+import threading
+from bisect import bisect_right
+
+import numpy as np
+
+"""
+Append-only on-disk recordings of transitions (or any other rows of fixed shape arrays).
+
+A recording is a directory containing `meta.json` and one directory per chunk with an `.npy` file per field, e.g.
+
+    meta.json                   {"fields": {"reward": {"dtype": "float32", "shape": []}, ...},
+                                 "chunks": [{"name": "chunk_000000", "length": 1000}, ...]}
+    chunk_000000/reward.npy     shape (1000,)
+    chunk_000000/obs_0.npy      shape (1000, 64, 256, 3)
+    ...
+
+Chunks are immutable once written and are listed in meta.json only after they are complete, so a recording can be read
+while it is being written. `Recording` memory-maps the chunks for random access without loading them.
+
+`VideoEncoder` streams frames to video files from a background thread.
+"""
+
+
+def flatten_obs(ob, prefix="obs"):
+    """{"obs": array} for arrays, {"obs_0": ..., "obs_1": ...} for tuples, {"obs_rgb": ...} for dicts (recursively)"""
+    if isinstance(ob, tuple):
+        return {k: v for i, o in enumerate(ob) for k, v in flatten_obs(o, f"{prefix}_{i}").items()}
+    if isinstance(ob, dict):
+        return {k: v for name, o in ob.items() for k, v in flatten_obs(o, f"{prefix}_{name}").items()}
+    return {prefix: ob}
+
+
+def write_json(path, obj):
+    """Atomically replaces `path`"""
+    with open(path + ".tmp", "w") as f:
+        json.dump(obj, f, indent=1)
+    os.replace(path + ".tmp", path)
+
+
+def read_meta(path):
+    meta_path = os.path.join(path, "meta.json")
+    if not os.path.exists(meta_path):
+        return dict(fields={}, chunks=[])
+    with open(meta_path) as f:
+        return json.load(f)
+
+
+class ChunkWriter:
+    """Appends rows (dicts of arrays with a fixed shape per field) to the recording at `path`.
+
+    Rows are copied into preallocated chunk buffers. Full chunks are written by a background thread, at most
+    `max_pending` chunks wait for it (after that `append` blocks), so memory stays bounded. Appending to an existing
+    recording continues after its last complete chunk.
+    """
+    def __init__(self, path, chunk_size=1000, max_pending=2):
+        self.path = path
+        self.chunk_size = chunk_size
+        os.makedirs(path, exist_ok=True)
+        self.meta = read_meta(path)
+        self.buffers = None
+        self.n = 0
+        self.error = None
+        self.queue = queue.Queue(max_pending)
+        self.thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.thread.start()
+
+    def __len__(self):
+        """Number of rows written completely"""
+        return sum(c["length"] for c in self.meta["chunks"])
+
+    def append(self, row):
+        if self.error is not None:
+            raise self.error
+        if self.buffers is None:
+            row = {k: np.asarray(v) for k, v in row.items()}
+            fields = {k: dict(dtype=v.dtype.str, shape=v.shape) for k, v in row.items()}
+            if not self.meta["fields"]:
+                self.meta["fields"] = fields
+            assert self.meta["fields"].keys() == fields.keys(), f"Expected {self.meta['fields'].keys()}, got {fields.keys()}"
+            self.buffers = {k: np.empty((self.chunk_size,) + tuple(f["shape"]), f["dtype"])
+                            for k, f in self.meta["fields"].items()}
+        for k, v in row.items():
+            self.buffers[k][self.n] = v
+        self.n += 1
+        if self.n == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Hands the current (possibly not full) chunk to the writer thread"""
+        if self.n:
+            self.queue.put((self.buffers, self.n))
+            self.buffers, self.n = None, 0
+
+    def _write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            buffers, n = item
+            try:
+                name = f"chunk_{len(self.meta['chunks']):06d}"
+                tmp = os.path.join(self.path, name + ".tmp")
+                os.makedirs(tmp, exist_ok=True)
+                for k, b in buffers.items():
+                    np.save(os.path.join(tmp, k + ".npy"), b[:n])
+                if os.path.exists(os.path.join(self.path, name)):  # left over from a crash before meta.json was written
+                    shutil.rmtree(os.path.join(self.path, name))
+                os.replace(tmp, os.path.join(self.path, name))
+                self.meta["chunks"].append(dict(name=name, length=n))
+                write_json(os.path.join(self.path, "meta.json"), self.meta)
+            except Exception as e:
+                self.error = e
+
+    def close(self):
+        if self.thread.is_alive():
+            self.flush()
+            self.queue.put(None)
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+class Recording:
+    """Memory-mapped random access to the complete chunks of a recording"""
+    def __init__(self, path):
+        self.path = path
+        meta = read_meta(path)
+        self.fields = meta["fields"]
+        self.chunks = [{k: np.load(os.path.join(path, c["name"], k + ".npy"), mmap_mode="r") for k in self.fields}
+                       for c in meta["chunks"]]
+        self.offsets = np.cumsum([0] + [c["length"] for c in meta["chunks"]])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def locate(self, i):
+        """(chunk index, index within the chunk) of row i"""
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        j = bisect_right(self.offsets, i) - 1
+        return j, i - int(self.offsets[j])
+
+    def __getitem__(self, i):
+        j, k = self.locate(i)
+        return {name: a[k] for name, a in self.chunks[j].items()}
+
+    def field(self, name):
+        """Per chunk memory maps of one field"""
+        return [c[name] for c in self.chunks]
+
+
+class VideoEncoder:
+    """Encodes frames to video files (anything imageio can write incrementally, e.g. .mp4 or .gif) in a background
+    thread. For .mp4 the encoding itself runs in an ffmpeg process (imageio-ffmpeg) and the thread only feeds it, .gif
+    is encoded in Python and competes with the rollout for the GIL.
+
+    At most `max_queue` frames wait for the encoder. When that many are waiting `write` drops the frame if `drop` is set
+    (counted in `dropped`), otherwise it blocks until the encoder catches up. Videos are written to a temporary file
+    next to their destination and only appear under their final name once complete.
+    """
+    def __init__(self, fps=20, max_queue=64, drop=True):
+        self.fps = fps
+        self.drop = drop
+        self.dropped = 0
+        self.error = None
+        self.commands = queue.Queue()
+        self.slots = threading.Semaphore(max_queue)
+        self.thread = threading.Thread(target=self._encode_loop, daemon=True)
+        self.thread.start()
+
+    def open(self, path):
+        """Starts a new video (finishing the previous one if it wasn't)"""
+        self._put(("open", path))
+
+    def write(self, frame):
+        if self.slots.acquire(not self.drop):
+            self._put(frame)
+        else:
+            self.dropped += 1
+
+    def finish(self, path=None):
+        """Completes the current video, moving it to `path` if given. Without `path` the video is saved where it was
+        opened, with `path=False` it is discarded. Returns immediately."""
+        self._put(("finish", path))
+
+    def _put(self, item):
+        if self.error is not None:
+            raise self.error
+        self.commands.put(item)
+
+    def _encode_loop(self):
+        import imageio
+        writer = dest = tmp = None
+        while True:
+            item = self.commands.get()
+            try:
+                if isinstance(item, np.ndarray):
+                    self.slots.release()
+                    if writer is not None:
+                        writer.append_data(item[..., 0] if item.shape[-1] == 1 else item)
+                    continue
+                cmd, path = item or ("finish", None)
+                if cmd == "finish" and path is not None:
+                    dest = path
+                if writer is not None:
+                    writer.close()
+                    writer = None
+                    if not os.path.exists(tmp):  # no frames were written (some writers create the file lazily)
+                        pass
+                    elif dest is False:
+                        os.remove(tmp)
+                    else:
+                        os.makedirs(os.path.dirname(os.path.abspath(dest)), exist_ok=True)
+                        os.replace(tmp, dest)
+                if item is None:
+                    return
+                if cmd == "open":
+                    root, ext = os.path.splitext(path)
+                    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+                    tmp, dest = root + ".tmp" + ext, path
+                    writer = imageio.get_writer(tmp, fps=self.fps)
+            except Exception as e:
+                writer = None
+                self.error = e
+
+    def close(self):
+        """Completes the current video and waits for the encoder"""
+        if self.thread.is_alive():
+            self.commands.put(None)
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def test_video_encoder(max_queue=4, frames=6):
+    import tempfile
+    import imageio
+
+    class StalledEncoder(VideoEncoder):
+        """Doesn't start encoding before `resume` is set, i.e. the queue fills up"""
+        def __init__(self, **kwargs):
+            self.resume = threading.Event()
+            super().__init__(**kwargs)
+
+        def _encode_loop(self):
+            self.resume.wait()
+            super()._encode_loop()
+
+    for drop in (True, False):
+        path = os.path.join(tempfile.mkdtemp(), "video.gif")
+        encoder = StalledEncoder(max_queue=max_queue, drop=drop)
+        encoder.open(path)
+        writer = threading.Thread(target=lambda: [encoder.write(np.full((16, 16, 3), 40 * i, np.uint8))
+                                                  for i in range(frames)])
+        writer.start()
+        writer.join(0.5)
+        assert writer.is_alive() != drop  # the frames beyond max_queue are dropped or block
+        assert encoder.dropped == (frames - max_queue if drop else 0)
+        encoder.resume.set()
+        writer.join()
+        encoder.close()
+        assert len(imageio.mimread(path)) == (max_queue if drop else frames)
+        shutil.rmtree(os.path.dirname(path))
+
+
+def test_chunk_writer_resume(chunk_size=4):
+    import tempfile
+    path = tempfile.mkdtemp()
+    writer = ChunkWriter(path, chunk_size)
+    for i in range(10):  # two full chunks and a partial one
+        writer.append(dict(x=np.full(3, i, np.float32), i=i))
+    writer.close()
+    assert len(writer) == 10 and [c["length"] for c in read_meta(path)["chunks"]] == [4, 4, 2]
+
+    # a crash after a chunk was moved into place but before meta.json listed it, and one while a chunk was written
+    os.makedirs(os.path.join(path, "chunk_000003"))
+    np.save(os.path.join(path, "chunk_000003", "i.npy"), np.full(4, -1))
+    os.makedirs(os.path.join(path, "chunk_000004.tmp"))
+
+    writer = ChunkWriter(path, chunk_size)
+    assert len(writer) == 10
+    for i in range(10, 15):
+        writer.append(dict(x=np.full(3, i, np.float32), i=i))
+    writer.close()
+    rec = Recording(path)
+    assert len(rec) == 15 and [c["length"] for c in read_meta(path)["chunks"]] == [4, 4, 2, 4, 1]
+    assert [int(rec[j]["i"]) for j in range(15)] == list(range(15))
+    assert np.array_equal(rec[12]["x"], np.full(3, 12, np.float32))
+
+    writer = ChunkWriter(path, chunk_size)
+    try:
+        writer.append(dict(y=0))
+        assert False, "expected the fields to be checked against the recording"
+    except AssertionError as e:
+        assert "Expected" in str(e)
+    writer.close()
+    shutil.rmtree(path)
+
+
+if __name__ == "__main__":
+    test_chunk_writer_resume()
+    test_video_encoder()
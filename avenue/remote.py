@@ -0,0 +1,321 @@
+import argparse
+import json
+import os
+import socket
+import struct
+import sys
+import tempfile
+import threading
+
+import numpy as np
+
+"""
+Envs on other machines: `avenue-server` hosts a pool of envs (a `VecAvenue`) and `RemoteVecEnv` steps it over TCP or a
+Unix socket with the interface of `VecAvenue`, e.g.
+
+    simulator box:  avenue-server RaceSolo-v0 -n 16 --address tcp://0.0.0.0:5500
+    learner:        env = RemoteVecEnv("tcp://simbox:5500")
+
+The server only accepts local connections unless it is given a public address (e.g. tcp://0.0.0.0:5500), there is
+no authentication.
+
+Every message is an opcode byte, the payload length (uint64) and the payload. After connecting the server sends the
+spaces as json ("H"), then the client sends "R" (reset), "S" (step, the actions of all envs as raw bytes), "I" (like
+"S" but with infos) or "C" (close) and the server answers each "R", "S" and "I" with one message for all envs:
+
+    "R": the observation leaves (see `vector.obs_leaves`) as raw bytes, each of shape (num_envs, ...)
+    "S": observation leaves, rewards (float32), dones (uint8), a mask (uint8) of the envs with a terminal observation,
+         the leaves of those terminal observations
+    "I": the same followed by the infos as json
+
+Frames are sent as they are in the pool's shared memory (uint8) and are received into a fresh buffer that the returned
+arrays are views of.
+"""
+
+VERSION = 2
+HEADER = struct.Struct("!cQ")
+
+
+def parse_address(address):
+    """"tcp://host:port" or "unix:///path" to (family, address)"""
+    if address.startswith("unix://"):
+        return socket.AF_UNIX, address[len("unix://"):]
+    host, port = address[len("tcp://"):].rsplit(":", 1) if address.startswith("tcp://") else address.rsplit(":", 1)
+    return socket.AF_INET, (host, int(port))
+
+
+def send(sock, op, *parts):
+    """Sends a message, large parts (e.g. frames) are passed to the socket without copying them"""
+    parts = [memoryview(p).cast("B") for p in parts]
+    small = [p for p in parts if p.nbytes < 65536]
+    if len(small) == len(parts):
+        return sock.sendall(HEADER.pack(op, sum(p.nbytes for p in parts)) + b"".join(parts))
+    sock.sendall(HEADER.pack(op, sum(p.nbytes for p in parts)))
+    for p in parts:
+        sock.sendall(p)
+
+
+def recv_exactly(sock, n):
+    buf = bytearray(n)
+    view = memoryview(buf)
+    while view:
+        k = sock.recv_into(view)
+        if not k:
+            raise ConnectionError("connection closed")
+        view = view[k:]
+    return buf
+
+
+def recv(sock):
+    op, n = HEADER.unpack(recv_exactly(sock, HEADER.size))
+    return op, recv_exactly(sock, n)
+
+
+def bound_to_json(x):
+    return x.flat[0].item() if np.all(x == x.flat[0]) else x.tolist()  # a scalar if uniform, e.g. for frames
+
+
+def space_to_json(space):
+    import gym
+    if isinstance(space, gym.spaces.Tuple):
+        return dict(type="Tuple", spaces=[space_to_json(s) for s in space.spaces])
+    if isinstance(space, gym.spaces.Dict):
+        return dict(type="Dict", spaces={k: space_to_json(s) for k, s in space.spaces.items()})
+    return dict(type="Box", shape=space.shape, dtype=np.dtype(space.dtype).str, low=bound_to_json(space.low),
+                high=bound_to_json(space.high))
+
+
+def space_from_json(d):
+    import gym
+    if d["type"] == "Tuple":
+        return gym.spaces.Tuple([space_from_json(s) for s in d["spaces"]])
+    if d["type"] == "Dict":
+        return gym.spaces.Dict({k: space_from_json(s) for k, s in d["spaces"].items()})
+    shape, dtype = tuple(d["shape"]), np.dtype(d["dtype"])
+    return gym.spaces.Box(np.full(shape, d["low"], dtype), np.full(shape, d["high"], dtype), shape, dtype)
+
+
+def jsonable(x):
+    if isinstance(x, np.ndarray):
+        return x.tolist()
+    if isinstance(x, np.generic):
+        return x.item()
+    if hasattr(x, "_asdict"):
+        return jsonable(x._asdict())
+    if isinstance(x, dict):
+        return {str(k): jsonable(v) for k, v in x.items()}
+    if isinstance(x, (list, tuple)):
+        return [jsonable(v) for v in x]
+    if x is None or isinstance(x, (bool, int, float, str)):
+        return x
+    return repr(x)
+
+
+class Server:
+    """Serves the vectorized env `venv` (e.g. a `VecAvenue` with `copy=False`) to one client at a time"""
+    def __init__(self, venv, address):
+        self.venv = venv
+        family, self.address = parse_address(address)
+        if family == socket.AF_UNIX and os.path.exists(self.address):
+            os.remove(self.address)  # left over from a previous server
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(self.address)
+        self.sock.listen(1)
+        self.handshake = json.dumps(dict(version=VERSION, num_envs=venv.num_envs,
+                                         observation_space=space_to_json(venv.observation_space),
+                                         action_space=space_to_json(venv.action_space))).encode()
+
+    def serve(self, clients=None):
+        """Serves `clients` clients one after the other (forever if None)"""
+        while clients is None or clients > 0:
+            conn, peer = self.sock.accept()
+            with conn:
+                if conn.family == socket.AF_INET:
+                    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                try:
+                    self.serve_client(conn)
+                except Exception as e:  # e.g. a client that sent garbage or went away mid-message, serve the next one
+                    print(f"Client {peer or 'on ' + self.address} failed: {e!r}", flush=True)
+            clients = None if clients is None else clients - 1
+
+    def serve_client(self, conn):
+        from .vector import obs_leaves
+        send(conn, b"H", self.handshake)
+        action_space = self.venv.action_space
+        while True:
+            try:
+                op, payload = recv(conn)
+            except ConnectionError:
+                return
+            if op == b"R":
+                send(conn, b"R", *obs_leaves(self.venv.reset()))
+            elif op in (b"S", b"I"):
+                actions = np.frombuffer(payload, action_space.dtype).reshape((self.venv.num_envs,) + action_space.shape)
+                ob, rewards, dones, infos = self.venv.step(actions)
+                terminal = [info.pop("terminal_observation", None) for info in infos]
+                mask = np.array([t is not None for t in terminal], np.uint8)
+                terminal_leaves = [np.stack(x) for x in zip(*[obs_leaves(t) for t in terminal if t is not None])]
+                json_infos = [json.dumps(jsonable(infos)).encode()] if op == b"I" else []
+                send(conn, op, *obs_leaves(ob), np.asarray(rewards, np.float32), np.asarray(dones, np.uint8), mask,
+                     *terminal_leaves, *json_infos)
+            elif op == b"C":
+                return
+            else:
+                raise ValueError(f"Unknown opcode {op}")
+
+    def close(self):
+        self.sock.close()
+        if self.sock.family == socket.AF_UNIX and os.path.exists(self.address):
+            os.remove(self.address)
+
+
+class RemoteVecEnv:
+    """Client for `Server`, has the same interface as `VecAvenue`. The returned observations are never overwritten.
+
+    The infos only contain the terminal observations unless `infos=True`, then the server sends the rest of them (e.g.
+    avenue_state) as json on every step, which costs more than the rest of the message.
+    """
+    def __init__(self, address, infos=False):
+        from .vector import space_leaves
+        self.closed = False
+        self.infos = infos
+        family, address = parse_address(address)
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.connect(address)
+        if family == socket.AF_INET:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        op, payload = recv(self.sock)
+        assert op == b"H", f"Expected a handshake, got {op}"
+        handshake = json.loads(payload)
+        assert handshake["version"] == VERSION, f"Server speaks version {handshake['version']}, we speak {VERSION}"
+        self.num_envs = handshake["num_envs"]
+        self.observation_space = space_from_json(handshake["observation_space"])
+        self.action_space = space_from_json(handshake["action_space"])
+        self.leaves = [(b.shape, np.dtype(b.dtype)) for b in space_leaves(self.observation_space)]
+
+    def read_leaves(self, buf, offset, n):
+        """Views of `n` stacked observations in `buf` starting at `offset`"""
+        leaves = []
+        for shape, dtype in self.leaves:
+            count = n * int(np.prod(shape))
+            leaves.append(np.frombuffer(buf, dtype, count, offset).reshape((n,) + shape))
+            offset += count * dtype.itemsize
+        return leaves, offset
+
+    def reset(self):
+        from .vector import obs_unflatten
+        send(self.sock, b"R")
+        op, payload = recv(self.sock)
+        leaves, _ = self.read_leaves(payload, 0, self.num_envs)
+        return obs_unflatten(self.observation_space, iter(leaves))
+
+    def step_async(self, actions):
+        actions = np.asarray(actions, self.action_space.dtype).reshape((self.num_envs,) + self.action_space.shape)
+        send(self.sock, b"I" if self.infos else b"S", np.ascontiguousarray(actions))
+
+    def step_wait(self):
+        from .vector import obs_unflatten
+        n = self.num_envs
+        op, payload = recv(self.sock)
+        leaves, offset = self.read_leaves(payload, 0, n)
+        rewards = np.frombuffer(payload, np.float32, n, offset)
+        dones = np.frombuffer(payload, np.uint8, n, offset + 4 * n).astype(bool)
+        mask = np.frombuffer(payload, np.uint8, n, offset + 5 * n).astype(bool)
+        terminal, offset = self.read_leaves(payload, offset + 6 * n, int(mask.sum()))
+        infos = json.loads(payload[offset:]) if self.infos else [{} for _ in range(n)]
+        for i, k in enumerate(np.flatnonzero(mask)):
+            infos[k]["terminal_observation"] = obs_unflatten(self.observation_space, iter([t[i] for t in terminal]))
+        return obs_unflatten(self.observation_space, iter(leaves)), rewards, dones, infos
+
+    def step(self, actions):
+        self.step_async(actions)
+        return self.step_wait()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            try:
+                send(self.sock, b"C")
+            except OSError:
+                pass
+            self.sock.close()
+
+    def __del__(self):
+        if hasattr(self, "sock"):
+            self.close()
+
+
+def test_loopback(n=2, steps=30):
+    import avenue
+    from functools import partial
+    from .backends import StubUnityEnv
+    address = "unix://" + os.path.join(tempfile.mkdtemp(), "avenue.sock")
+    venv = avenue.make_vec("RaceSolo-v0", n, copy=False, backend=partial(StubUnityEnv, episode_length=5))
+    server = Server(venv, address)
+    thread = threading.Thread(target=server.serve, args=(3,), daemon=True)
+    thread.start()
+    try:
+        bad = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)  # the server survives a broken client
+        bad.connect(parse_address(address)[1])
+        recv(bad)
+        send(bad, b"X")
+        bad.close()
+
+        for with_infos in (False, True):
+            env = RemoteVecEnv(address, infos=with_infos)
+            try:
+                assert env.num_envs == n and env.observation_space == venv.observation_space
+                ob = env.reset()
+                assert env.observation_space.contains(tuple(x[0] for x in ob))
+                episodes = 0
+                for _ in range(steps):
+                    ob, rewards, dones, infos = env.step([env.action_space.sample() for _ in range(n)])
+                    assert ob[0].shape == (n, 64, 256, 3) and ob[0].dtype == np.uint8
+                    assert rewards.shape == dones.shape == (n,)
+                    assert all(("avenue_state" in info) == with_infos for info in infos)
+                    for i, (info, done) in enumerate(zip(infos, dones)):
+                        assert ("terminal_observation" in info) == done
+                        if done:
+                            episodes += 1
+                            terminal = info["terminal_observation"]
+                            assert terminal[0].shape == ob[0][i].shape and not np.array_equal(terminal[0], ob[0][i])
+                assert episodes > 0
+            finally:
+                env.close()
+    finally:
+        thread.join()
+        server.close()
+        venv.close()
+
+
+def main(args=None):
+    import avenue
+    from .bench import make_backend
+    parser = argparse.ArgumentParser(prog="avenue-server", description="Serves a pool of envs to a RemoteVecEnv")
+    parser.add_argument("env", help="e.g. RaceSolo-v0")
+    parser.add_argument("-n", type=int, default=1, help="number of envs (each in its own worker process)")
+    parser.add_argument("--address", default="tcp://127.0.0.1:5500",
+                        help="tcp://host:port or unix:///path, e.g. tcp://0.0.0.0:5500 to accept remote connections")
+    parser.add_argument("--backend", choices=("unity", "stub", "replay"), default="unity")
+    parser.add_argument("--recording", help="path of a recording for the replay backend (see avenue.recording)")
+    args = parser.parse_args(args)
+    venv = avenue.make_vec(args.env, args.n, copy=False, backend=make_backend(args.backend, recording=args.recording))
+    server = Server(venv, args.address)
+    print(f"Serving {args.n} {args.env} on {args.address}", flush=True)
+    try:
+        server.serve()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        venv.close()
+    return 0
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["test"]:  # python -m avenue.remote test
+        test_loopback()
+    else:
+        sys.exit(main())
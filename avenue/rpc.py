@@ -1,3 +1,9 @@
+from functools import lru_cache
+from itertools import accumulate
+from operator import itemgetter
+
+import numpy as np
+
 from .util import namedtuple
 
 """
@@ -88,3 +94,38 @@ class FollowCar(namedtuple):
     car_to_follow_forward = 1
     is_car_visible = 1
     dir_projection_car = 1
+
+
+class VectorDecoder:
+    """Splits flat float32 vector observations into `state_class` namedtuples whose fields are views (no copies).
+
+    The slice table is computed once. The same decoder works on a single observation of shape (D,) and on a batch of
+    shape (N, D), in which case every field is an (N, size) column view. Like `np.split`, the last field takes whatever
+    remains of the vector.
+    """
+    def __init__(self, state_class):
+        self.state_class = state_class
+        self.names = state_class._nt._fields
+        self.sizes = tuple(state_class())
+        self.size = sum(self.sizes)
+        ends = tuple(accumulate(self.sizes))
+        self.slices = tuple(slice(e - s, e) for s, e in zip(self.sizes[:-1], ends)) + (slice(ends[-2], None),)
+        self._getter = itemgetter(*((Ellipsis, s) for s in self.slices))
+        self._make = state_class._nt._make
+
+    def __call__(self, vec, out=None):
+        """If `out` is given `vec` is copied into it and the returned fields are views into `out`"""
+        if out is None:
+            buf = np.asarray(vec, dtype=np.float32)
+        else:
+            np.copyto(out, vec, casting='unsafe')
+            buf = out
+        return self._make(self._getter(buf))
+
+
+@lru_cache(maxsize=None)
+def decoder(state_class):
+    """Returns the (cached) VectorDecoder for a state class or the name of a state class (e.g. "AvenueCar")"""
+    if isinstance(state_class, str):
+        state_class = globals()[state_class]
+    return VectorDecoder(state_class)
@@ -0,0 +1,121 @@
+import atexit
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+
+"""
+Opt-in per-process instrumentation: timing histograms and counters for the stages of a step (Unity round trip,
+decoding, rgb conversion, reward, wrappers) and for events (steps, resets, relaunches, reconfigurations, env swaps).
+
+It is disabled by default, in which case every call site costs a global lookup and a function call. Enable it with
+`avenue.stats.enable()` or by setting $AVENUE_STATS to a file that snapshots are appended to (as json lines)
+periodically, which also enables it in worker processes. Call sites look like
+
+    t0 = stats.clock()
+    ...
+    stats.record("decode", t0)
+"""
+
+enabled = False
+_lock = threading.Lock()
+_timings = {}
+_counters = defaultdict(int)
+_dumper = None
+
+
+class Histogram:
+    """Durations in log2 spaced buckets, bucket i counts durations in [2**(i-1), 2**i) microseconds"""
+    __slots__ = ("count", "total", "min", "max", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.
+        self.min = float("inf")
+        self.max = 0.
+        self.buckets = [0] * 40
+
+    def add(self, us):
+        self.count += 1
+        self.total += us
+        self.min = min(self.min, us)
+        self.max = max(self.max, us)
+        self.buckets[min(int(us).bit_length(), 39)] += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket containing the q-quantile"""
+        target, seen = q * self.count, 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= target:
+                return min(float(2 ** i), self.max)
+        return self.max
+
+    def summary(self):
+        return dict(count=self.count, mean_us=self.total / max(self.count, 1), min_us=self.min if self.count else 0.,
+                    max_us=self.max, p50_us=self.quantile(.5), p90_us=self.quantile(.9), p99_us=self.quantile(.99),
+                    buckets={2 ** i: n for i, n in enumerate(self.buckets) if n})
+
+
+def clock():
+    return time.perf_counter() if enabled else 0.
+
+
+def record(name, t0):
+    """Adds the time since `t0 = clock()` to the histogram `name`"""
+    if enabled:
+        us = (time.perf_counter() - t0) * 1e6
+        with _lock:
+            h = _timings.get(name)
+            if h is None:
+                h = _timings[name] = Histogram()
+            h.add(us)
+
+
+def count(name, n=1):
+    if enabled:
+        with _lock:
+            _counters[name] += n
+
+
+def snapshot():
+    with _lock:
+        return dict(time=time.time(), pid=os.getpid(), counters=dict(_counters),
+                    timings={k: h.summary() for k, h in _timings.items()})
+
+
+def clear():
+    with _lock:
+        _timings.clear()
+        _counters.clear()
+
+
+def dump(path):
+    with open(path, "a") as f:
+        f.write(json.dumps(snapshot()) + "\n")
+
+
+def _dump_periodically(path, interval):
+    while True:
+        time.sleep(interval)
+        dump(path)
+
+
+def enable(path=None, interval=60.):
+    """Starts recording. If `path` is given a snapshot is appended to it every `interval` seconds and at exit."""
+    global enabled, _dumper
+    enabled = True
+    if path is not None and _dumper is None:
+        _dumper = threading.Thread(target=_dump_periodically, args=(path, interval), daemon=True)
+        _dumper.start()
+        atexit.register(dump, path)
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+if os.environ.get("AVENUE_STATS"):
+    enable(os.environ["AVENUE_STATS"], float(os.environ.get("AVENUE_STATS_INTERVAL", 60)))
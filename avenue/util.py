@@ -1,9 +1,23 @@
 import platform
 import os
+import random
+import socket
+import tempfile
+import time
+import inspect
+import hashlib
+import zipfile
+from contextlib import contextmanager
 from functools import partial
 import collections
 import numpy as np
 
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+    import msvcrt
+
 
 def ensure_executable(bin):
     if platform.system().lower() not in ('linux', 'darwin'):
@@ -35,6 +49,67 @@ def compute_asset_path(asset_id):
     return path
 
 
+def find_shared_asset(asset_id):
+    """Looks for an already unpacked asset in the read-only caches listed in $AVENUE_SHARED_ASSETS (os.pathsep
+    separated, e.g. a tmpfs or a shared volume), returns its path or None"""
+    for dir in filter(None, os.environ.get('AVENUE_SHARED_ASSETS', '').split(os.pathsep)):
+        path = os.path.join(dir, asset_id)
+        if os.path.isdir(path):
+            return path
+
+
+def lock_file(f, blocking=True):
+    """Takes an exclusive lock (across processes) on the open file `f`, raises OSError if `blocking` is False and
+    another process holds it. Uses flock, or msvcrt.locking on windows."""
+    if fcntl is not None:
+        fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        return
+    f.seek(0)
+    while True:
+        try:
+            return msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            if not blocking:
+                raise
+            time.sleep(.1)
+
+
+@contextmanager
+def file_lock(path):
+    """Blocks until this process holds an exclusive lock on `path` (across processes)"""
+    with open(path, 'a') as f:
+        lock_file(f)
+        yield
+
+
+def sha256(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(partial(f.read, chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def check_zip(path, expected_sha256=None):
+    """Raises zipfile.BadZipFile if `path` isn't a complete zip archive with intact members (e.g. a truncated download
+    or an html error page instead of the file) or, if `expected_sha256` is given, has a different sha256"""
+    if expected_sha256 is not None and sha256(path) != expected_sha256:
+        raise zipfile.BadZipFile(f"{path} doesn't have the sha256 {expected_sha256}")
+    with zipfile.ZipFile(path) as zip_ref:
+        bad = zip_ref.testzip()
+    if bad is not None:
+        raise zipfile.BadZipFile(f"{bad} in {path} is corrupt")
+
+
+def download(url, output):
+    """Streams `url` to `output` with a progress bar, continuing a previous partial download if possible"""
+    import gdown
+    if "resume" in inspect.signature(gdown.download).parameters:
+        gdown.download(url, output, quiet=False, resume=True)
+    else:  # older gdown versions
+        gdown.download(url, output, quiet=False)
+
+
 class namedtuple(tuple):
 
     """An easier to use namedtuple. Example:
@@ -51,13 +126,103 @@ class namedtuple(tuple):
     def __init_subclass__(cls):
       annots = tuple(getattr(cls, '__annotations__', {}).keys())
       fields = tuple(n for n in vars(cls) if not n.startswith('__'))
-      cls._nt = collections.namedtuple(cls.__name__, annots + fields)
+      cls._nt = collections.namedtuple(cls.__name__, annots + fields, module=cls.__module__)
+      cls._nt.__qualname__ = cls.__qualname__ + "._nt"  # so that instances can be pickled (e.g. sent by VecAvenue)
       cls._nt.__new__.__defaults__ = tuple(vars(cls)[f] for f in fields)
 
     def __new__(cls, *args, **kwargs):
       return cls._nt(*args, **kwargs)
 
 
+class FileLock:
+    """An exclusive lock on a lock file (see `try_lock`), `close` releases it and removes the file"""
+    def __init__(self, path, f):
+        self.path = path
+        self.f = f
+
+    def close(self):
+        if self.f.closed:
+            return
+        if fcntl is not None:
+            remove_file(self.path)  # while still holding the lock, see `try_lock`
+            self.f.close()
+        else:
+            self.f.close()
+            remove_file(self.path)  # fails if another process has it open, windows can't remove open files
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def try_lock(path):
+    """Returns a `FileLock` holding an exclusive lock on `path` or None if another process holds it.
+
+    The lock is released when it is closed or the process dies. Closing removes the lock file, so that lock files
+    don't pile up. Since a process might open the file just before its holder removes it, the lock only counts if
+    `path` still is the file we locked.
+    """
+    f = open(path, 'a')
+    try:
+        lock_file(f, blocking=False)
+        if fcntl is not None and not os.path.samestat(os.fstat(f.fileno()), os.stat(path)):
+            raise OSError(f"{path} was replaced after we opened it")
+    except OSError:  # includes FileNotFoundError from os.stat if it was removed
+        f.close()
+        return None
+    return FileLock(path, f)
+
+
+def port_free(port, host='localhost'):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        try:
+            s.bind((host, port))
+            return True
+        except OSError:
+            return False
+
+
+def acquire_worker_id(low=1000, high=20000, base_port=5005):
+    """Reserves an ML-Agents worker id (Unity listens on base_port + worker_id) that is unique on this node.
+
+    Ids are reserved across processes through lock files in $AVENUE_LOCK_DIR (default: the temp dir), ids whose port is
+    taken by something else are skipped. Returns (worker_id, lock), the id stays reserved until `lock.close()`.
+    """
+    lock_dir = os.environ.get('AVENUE_LOCK_DIR', tempfile.gettempdir())
+    start = random.randrange(high - low)  # random start to avoid contention between processes
+    for i in range(high - low):
+        worker_id = low + (start + i) % (high - low)
+        lock = try_lock(os.path.join(lock_dir, f'avenue-worker-{worker_id}.lock'))
+        if lock is None:
+            continue
+        if port_free(base_port + worker_id):
+            return worker_id, lock
+        lock.close()
+    raise RuntimeError(f"No free worker id in [{low}, {high})")
+
+
+GRAY_WEIGHTS = np.array([0.299, 0.587, 0.114], np.float32)  # ITU-R 601 luma
+
+
+def to_uint8(frame, out=None, gray=False):
+    """Converts a float image in [0, 1] of shape (height, width, 3) to uint8, truncating like `.astype(np.uint8)`.
+
+    The result is written into `out` (of shape (height, width, 3), or (height, width, 1) if `gray`) if it is given.
+    Unlike `(255 * frame).astype(np.uint8)` this doesn't allocate a full size float intermediate.
+    """
+    if out is None:
+        out = np.empty(frame.shape[:-1] + ((1,) if gray else frame.shape[-1:]), np.uint8)
+    if gray:
+        luma = np.matmul(frame, GRAY_WEIGHTS * 255)  # (height, width) float, a third of the size of the frame
+        np.copyto(out[..., 0], luma, casting='unsafe')
+    else:
+        np.multiply(frame, 255, out=out, casting='unsafe')
+    return out
+
+
 def min_max_norm(x, min_value, max_value):
   return ((x - min_value) / (max_value - min_value) - 0.5) * 2
 
@@ -77,8 +242,20 @@ def test_namedtuple():
   assert x == (8, 4, 5) and x.b == 5 and x.a == 4 and x == A(8, 4, 5)
 
 
+def test_try_lock():
+    path = os.path.join(tempfile.mkdtemp(), 'test.lock')
+    lock = try_lock(path)
+    assert lock is not None and try_lock(path) is None  # flock conflicts between open files of the same process too
+    lock.close()
+    assert not os.path.exists(path)
+    lock = try_lock(path)
+    assert lock is not None
+    lock.close()
+
+
 if __name__ == "__main__":
   test_namedtuple()
+  test_try_lock()
 
 
 
@@ -0,0 +1,323 @@
+import multiprocessing as mp
+import os
+from multiprocessing.connection import wait
+from multiprocessing.shared_memory import SharedMemory
+
+import gym
+import numpy as np
+
+from .placement import THREAD_VARS, apply, thread_environ
+
+
+"""
+Vectorized Avenue envs. Each env lives in its own worker process (together with its Unity instance). Observations are
+written by the workers straight into shared-memory arrays of shape (num_envs, ...) so that only rewards, dones and the
+(small) info dicts travel over the pipes.
+"""
+
+
+def space_leaves(space):
+    """Flattens a Box, Tuple or Dict space into a list of Boxes (same order as `obs_leaves`)"""
+    if isinstance(space, gym.spaces.Tuple):
+        return [b for s in space.spaces for b in space_leaves(s)]
+    if isinstance(space, gym.spaces.Dict):
+        return [b for s in space.spaces.values() for b in space_leaves(s)]
+    assert isinstance(space, gym.spaces.Box), f"Unsupported observation space {space}"
+    return [space]
+
+
+def obs_leaves(ob):
+    if isinstance(ob, tuple):
+        return [x for o in ob for x in obs_leaves(o)]
+    if isinstance(ob, dict):
+        return [x for o in ob.values() for x in obs_leaves(o)]
+    return [ob]
+
+
+def obs_unflatten(space, leaves):
+    """Inverse of `obs_leaves`, consumes `leaves` (an iterator)"""
+    if isinstance(space, gym.spaces.Tuple):
+        return tuple(obs_unflatten(s, leaves) for s in space.spaces)
+    if isinstance(space, gym.spaces.Dict):
+        return {k: obs_unflatten(s, leaves) for k, s in space.spaces.items()}
+    return next(leaves)
+
+
+def shared_arrays(shms, boxes, n):
+    return [np.ndarray((n,) + box.shape, box.dtype, buffer=shm.buf) for shm, box in zip(shms, boxes)]
+
+
+def worker(remote, parent_remote, env_fn, idx, n, auto_reset, placement):
+    parent_remote.close()
+    if placement is not None:  # the thread count variables were set when this process was started
+        apply(placement.get("cores"), None, placement.get("nice"))  # before the env (and Unity) is created
+    env = env_fn()
+    remote.send((env.observation_space, env.action_space))
+    shms = [SharedMemory(name=name) for name in remote.recv()]
+    bufs = shared_arrays(shms, space_leaves(env.observation_space), n)
+
+    def write(ob):
+        for buf, x in zip(bufs, obs_leaves(ob)):
+            buf[idx] = x
+
+    try:
+        while True:
+            cmd, data = remote.recv()
+            if cmd == "step":
+                ob, r, d, info = env.step(data)
+                if d and auto_reset:
+                    leaves = (np.copy(x) for x in obs_leaves(ob))  # ob might be a buffer that reset overwrites
+                    info["terminal_observation"] = obs_unflatten(env.observation_space, leaves)
+                    ob = env.reset()
+                write(ob)
+                info.pop("brain_info", None)  # it contains the float frames which we don't want to pickle
+                remote.send((r, d, info))
+            elif cmd == "reset":
+                write(env.reset())
+                remote.send(None)
+            elif cmd == "close":
+                break
+            else:
+                raise ValueError(f"Unknown command {cmd}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        env.close()
+        del bufs
+        for shm in shms:
+            shm.close()
+        remote.close()
+
+
+class VecAvenue:
+    """Steps `len(env_fns)` envs in parallel worker processes.
+
+    Observations are batched along the first axis and have the same structure (array, tuple or dict) as the
+    observations of a single env. With `copy=False` the returned observations are views into the shared memory and
+    will be overwritten by the next call to `step` or `reset`.
+
+    With `auto_reset` the workers reset their env as soon as an episode is done, in the same round trip. The
+    observation returned for that env is then the first one of the next episode and the last one of the finished
+    episode is in `info["terminal_observation"]`.
+
+    `placements` (one per env, see `placement.plan`) are applied in the workers before their env is created, the thread
+    counts when the workers are started.
+
+    Stepping in lockstep runs at the speed of the slowest env. Instead `step_async(actions, env_ids)` can step a subset
+    of the envs and `step_wait_first(k)` returns the results of the first `k` envs that are done stepping together
+    with their ids, while the others keep running, e.g.
+
+        venv.step_async(actions)
+        while True:
+            env_ids, ob, rewards, dones, infos = venv.step_wait_first(k)
+            venv.step_async(policy(ob), env_ids)
+    """
+    def __init__(self, env_fns, context="spawn", copy=True, auto_reset=True, placements=None):
+        self.num_envs = n = len(env_fns)
+        self.copy = copy
+        self.placements = placements
+        self.closed = False
+        self.stepping = np.zeros(n, bool)  # envs with an action in flight
+        ctx = mp.get_context(context)
+        self.remotes, work_remotes = zip(*[ctx.Pipe() for _ in range(n)])
+        placements = placements or [None] * n
+        self.processes = [ctx.Process(target=worker, daemon=True,
+                                      args=(work_remote, remote, env_fn, i, n, auto_reset, placements[i]))
+                          for i, (work_remote, remote, env_fn) in enumerate(zip(work_remotes, self.remotes, env_fns))]
+        for p, placement in zip(self.processes, placements):
+            with thread_environ(None if placement is None else placement.get("threads")):
+                p.start()
+        for work_remote in work_remotes:
+            work_remote.close()
+
+        self.observation_space, self.action_space = [r.recv() for r in self.remotes][0]
+        boxes = space_leaves(self.observation_space)
+        self.shms = [SharedMemory(create=True, size=max(1, n * int(np.prod(b.shape)) * np.dtype(b.dtype).itemsize))
+                     for b in boxes]
+        self.bufs = shared_arrays(self.shms, boxes, n)
+        for r in self.remotes:
+            r.send([shm.name for shm in self.shms])
+
+    def observation(self):
+        return obs_unflatten(self.observation_space, iter([b.copy() if self.copy else b for b in self.bufs]))
+
+    def reset(self):
+        for i in np.flatnonzero(self.stepping):  # discard the steps in flight
+            self.remotes[i].recv()
+        self.stepping[:] = False
+        for r in self.remotes:
+            r.send(("reset", None))
+        for r in self.remotes:
+            r.recv()
+        return self.observation()
+
+    def step_async(self, actions, env_ids=None):
+        """Steps the envs `env_ids` (all if None) with `actions[j]` for env `env_ids[j]`"""
+        env_ids = range(self.num_envs) if env_ids is None else env_ids
+        for i, a in zip(env_ids, actions):
+            assert not self.stepping[i], f"env {i} is still stepping"
+            self.remotes[i].send(("step", a))
+            self.stepping[i] = True
+
+    def step_wait(self):
+        assert self.stepping.all(), "step_wait needs all envs to be stepping, use step_wait_first"
+        rewards, dones, infos = zip(*[r.recv() for r in self.remotes])
+        self.stepping[:] = False
+        return self.observation(), np.asarray(rewards, np.float32), np.asarray(dones, bool), list(infos)
+
+    def step_wait_first(self, k):
+        """Waits until at least `k` of the stepping envs are done and returns `(env_ids, ob, rewards, dones, infos)` for
+        `k` of them (the lowest ids among those ready), batched in the order of `env_ids`. Observations are copies."""
+        stepping = np.flatnonzero(self.stepping)
+        assert 0 < k <= len(stepping), f"{len(stepping)} envs are stepping, can't wait for {k}"
+        remotes = {self.remotes[i]: i for i in stepping}
+        ready = []
+        while len(ready) < k:
+            ready += [remotes.pop(r) for r in wait(list(remotes))]
+        env_ids = np.sort(ready)[:k]
+        rewards, dones, infos = zip(*[self.remotes[i].recv() for i in env_ids])
+        self.stepping[env_ids] = False
+        ob = obs_unflatten(self.observation_space, iter([b[env_ids] for b in self.bufs]))
+        return env_ids, ob, np.asarray(rewards, np.float32), np.asarray(dones, bool), list(infos)
+
+    def step(self, actions):
+        self.step_async(actions)
+        return self.step_wait()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for i in np.flatnonzero(self.stepping):  # discard the steps in flight
+            try:
+                self.remotes[i].recv()
+            except EOFError:
+                pass
+        self.stepping[:] = False
+        for r in self.remotes:
+            try:
+                r.send(("close", None))
+            except (BrokenPipeError, EOFError):
+                pass
+        for p in self.processes:
+            p.join()
+        del self.bufs
+        for shm in self.shms:
+            try:
+                shm.close()
+            except BufferError:  # the caller still holds views (copy=False)
+                pass
+            shm.unlink()
+
+    def __del__(self):
+        if hasattr(self, "bufs"):
+            self.close()
+
+
+def test_vec_avenue(n=2, steps=30):
+    import avenue
+    from functools import partial
+    from .backends import StubUnityEnv
+    venv = avenue.make_vec("RaceSolo-v0", n, copy=False, backend=partial(StubUnityEnv, episode_length=5))
+    try:
+        ob = venv.reset()
+        assert ob[0].shape == (n, 64, 256, 3) and ob[0].dtype == np.uint8 and ob[1].shape == (n, 2)
+        assert np.shares_memory(ob[0], venv.bufs[0])  # copy=False returns views of the shared memory
+        episodes = 0
+        for _ in range(steps):
+            ob, rewards, dones, infos = venv.step(np.stack([venv.action_space.sample() for _ in range(n)]))
+            assert rewards.shape == dones.shape == (n,) and len(infos) == n
+            for i, (info, done) in enumerate(zip(infos, dones)):
+                assert "brain_info" not in info and "avenue_state" in info
+                assert ("terminal_observation" in info) == done
+                if done:  # auto_reset: ob is the first frame of the next episode, the last one is in the info
+                    episodes += 1
+                    terminal = info["terminal_observation"]
+                    assert terminal[0].shape == ob[0][i].shape and not np.array_equal(terminal[0], ob[0][i])
+        assert episodes > 0
+    finally:
+        venv.close()
+
+
+def test_step_wait_first(slow=0.3, steps=40):
+    import avenue
+    from functools import partial
+    from .backends import StubUnityEnv
+    latencies = [slow, 0., slow, 0.]  # envs 1 and 3 are fast
+    n = len(latencies)
+    venv = VecAvenue([partial(avenue.make, "RaceSolo-v0", backend=partial(StubUnityEnv, latency=t, episode_length=5))
+                      for t in latencies])
+
+    def actions(k):
+        return np.stack([venv.action_space.sample() for _ in range(k)])
+
+    try:
+        venv.reset()
+        venv.step_async(actions(n))
+        env_ids, ob, rewards, dones, infos = venv.step_wait_first(2)
+        assert list(env_ids) == [1, 3] and list(venv.stepping) == [True, False, True, False]
+        assert ob[0].shape == (2, 64, 256, 3) and rewards.shape == dones.shape == (2,) and len(infos) == 2
+        venv.step_async(actions(2), env_ids)
+        env_ids, *_ = venv.step_wait_first(n)  # waits for the slow ones too
+        assert list(env_ids) == list(range(n)) and not venv.stepping.any()
+
+        venv.step_async(actions(n))
+        venv.step_wait_first(2)
+        venv.reset()  # discards the slow envs' steps in flight
+        assert not venv.stepping.any()
+        venv.step(actions(n))
+
+        episodes = 0
+        venv.step_async(actions(n))
+        for _ in range(steps):  # the fast envs run through several episodes while the slow ones take a step
+            env_ids, ob, _, dones, infos = venv.step_wait_first(1)
+            for j, (info, done) in enumerate(zip(infos, dones)):
+                assert ("terminal_observation" in info) == done
+                if done:
+                    episodes += 1
+                    assert not np.array_equal(info["terminal_observation"][0], ob[0][j])
+            venv.step_async(actions(len(env_ids)), env_ids)
+        assert episodes > 0
+    finally:
+        venv.close()  # with steps in flight
+
+
+class ThreadReport(gym.Wrapper):
+    """Adds the thread count variables the worker process was started with and, if threadpoolctl is installed, the
+    thread counts of the BLAS libraries it loaded to the infos (see `test_placement_threads`)"""
+    def step(self, action):
+        ob, r, d, info = self.env.step(action)
+        environ = os.environ
+        if os.path.exists("/proc/self/environ"):  # linux, without the changes made after the start
+            with open("/proc/self/environ", "rb") as f:
+                environ = dict(v.decode().partition("=")[::2] for v in f.read().split(b"\0") if v)
+        info = dict(info, thread_vars={v: environ.get(v) for v in THREAD_VARS})
+        try:
+            from threadpoolctl import threadpool_info
+        except ImportError:
+            return ob, r, d, info
+        info["blas_threads"] = [lib["num_threads"] for lib in threadpool_info() if lib["user_api"] == "blas"]
+        return ob, r, d, info
+
+
+def test_placement_threads(n=2, threads=1):
+    import avenue
+    from .backends import StubUnityEnv
+    before = {v: os.environ.get(v) for v in THREAD_VARS}
+    venv = avenue.make_vec("RaceSolo-v0", n, placement=dict(threads=threads), backend=StubUnityEnv,
+                           wrappers=[ThreadReport])
+    try:
+        assert {v: os.environ.get(v) for v in THREAD_VARS} == before  # the parent's environment is restored
+        venv.reset()
+        _, _, _, infos = venv.step(np.stack([venv.action_space.sample() for _ in range(n)]))
+        for info in infos:
+            assert all(value == str(threads) for value in info["thread_vars"].values())
+            assert all(t == threads for t in info.get("blas_threads", []))
+    finally:
+        venv.close()
+
+
+if __name__ == "__main__":
+    test_vec_avenue()
+    test_step_wait_first()
+    test_placement_threads()
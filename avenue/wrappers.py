@@ -1,62 +1,300 @@
+import asyncio
 import gym
+import gym.wrappers
 from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 import numpy as np
 import os
-import imageio
+import tempfile
+import threading
+import time
+from . import stats
+from .util import GRAY_WEIGHTS
 
 
-class RandomizedEnv(gym.Wrapper):
-    def __init__(self, env_fn, n=10000):
+class AsyncWrapper(gym.Wrapper):
+    """Wrapper with a split `step_async` / `step_wait` interface (see `UnityEnv`).
+
+    Subclasses transform the action in `step_async` and the transition in `step_wait` instead of overriding `step`, so
+    that the whole wrapper stack can be stepped without blocking, e.g.
+
+        env.step_async(action)
+        next_action = policy(other_obs)  # runs while Unity is simulating
+        ob, r, done, info = env.step_wait()
+    """
+    def step(self, action):
+        self.step_async(action, block=True)
+        return self.step_wait()
+
+    def step_async(self, action, block=False):
+        """Returns a `concurrent.futures.Future` that is done when the simulator step is"""
+        return self.env.step_async(action, block)
+
+    def step_wait(self):
+        return self.env.step_wait()
+
+    async def astep(self, action):
+        await asyncio.wrap_future(self.step_async(action))
+        return self.step_wait()
+
+
+class AsyncObservationWrapper(AsyncWrapper, gym.ObservationWrapper):
+    def step_wait(self):
+        ob, reward, done, info = self.env.step_wait()
+        t0 = stats.clock()
+        ob = self.observation(ob)
+        stats.record(type(self).__name__, t0)
+        return ob, reward, done, info
+
+
+class TimeLimit(AsyncWrapper, gym.wrappers.TimeLimit):
+    def step_wait(self):
+        ob, reward, done, info = self.env.step_wait()
+        self._elapsed_steps += 1
+        if self._elapsed_steps >= self._max_episode_steps:
+            info['TimeLimit.truncated'] = not done
+            done = True
+        return ob, reward, done, info
+
+
+class RandomizedEnv(AsyncWrapper):
+    """Replaces the env with a new one from `env_fn` at the first reset after `n` steps.
+
+    With `config_fn` the env is created as `env_fn(config_fn())` and after `n` steps a new config is sampled instead. If
+    the running env can apply it (see `UnityEnv.needs_relaunch`) it is reset with it in place, which is much cheaper
+    than launching a new Unity process, otherwise the env is replaced by `env_fn(config)`. In-place reconfigurations
+    are counted in `reconfigs`, replacements in `swaps`.
+
+    With `prefetch > 0` the next env is created in a background thread `prefetch` steps before it is due, so that the
+    swap at reset doesn't have to wait for Unity to launch. The time each swap blocked reset is kept in `swap_latencies`.
+    """
+    def __init__(self, env_fn, n=10000, prefetch=0, config_fn=None):
         self.n = n
         self.env_fn = env_fn
+        self.config_fn = config_fn
+        self.prefetch = prefetch
         self.epsiodes = 0
         self.steps_since_config = 0
-        super().__init__(env_fn())
+        self.swaps = 0
+        self.reconfigs = 0
+        self.swap_latencies = deque(maxlen=1000)
+        self._planned = False
+        self._next_config = None
+        self._next = None  # Future of the prewarmed env
+        self._closing = []  # threads closing replaced envs
+        self._executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        super().__init__(self.launch(None if config_fn is None else config_fn()))
+
+    def launch(self, config):
+        return self.env_fn() if config is None else self.env_fn(config)
+
+    def needs_relaunch(self, config):
+        return config is None or self.env.needs_relaunch(config)
+
+    def plan(self):
+        """Samples the next config and starts launching a new env for it if it needs one and prefetching is on"""
+        self._planned = True
+        self._next_config = None if self.config_fn is None else self.config_fn()
+        if self._executor is not None and self.needs_relaunch(self._next_config):
+            self._next = self._executor.submit(self.launch, self._next_config)
 
     def reset(self, **kwargs):
         self.epsiodes += 1
         if self.steps_since_config > self.n:
-            self.env.close()
-            self.env = self.env_fn()
+            if not self._planned:
+                self.plan()
+            config, self._planned, self._next_config = self._next_config, False, None
             self.steps_since_config = 0
+            t0 = time.perf_counter()
+            if self._next is None and not self.needs_relaunch(config):
+                ob = self.env.reset(config=config)
+                self.reconfigs += 1
+                stats.count("reconfigs")
+                stats.record("reconfig", t0)
+                return ob
+            old_env = self.env
+            if self._next is not None:
+                if not self._next.done():
+                    stats.count("swap_stalls")  # the prewarmed env isn't ready yet
+                self.env, self._next = self._next.result(), None
+                self._closing = [t for t in self._closing if t.is_alive()]
+                self._closing.append(threading.Thread(target=old_env.close))  # not a daemon, Unity has to be stopped
+                self._closing[-1].start()
+            else:
+                old_env.close()
+                self.env = self.launch(config)
+            self.swaps += 1
+            self.swap_latencies.append(time.perf_counter() - t0)
+            stats.count("swaps")
+            stats.record("swap", t0)
 
         return self.env.reset()
 
-    def step(self, action):
+    def step_async(self, action, block=False):
         self.steps_since_config += 1
-        return super().step(action)
+        if self.prefetch and not self._planned and self.steps_since_config >= self.n - self.prefetch:
+            self.plan()
+        return self.env.step_async(action, block)
+
+    def close(self):
+        if self._next is not None:
+            self._next.result().close()
+            self._next = None
+        if self._executor is not None:
+            self._executor.shutdown()
+        for thread in self._closing:
+            thread.join()
+        self._closing = []
+        return self.env.close()
+
 
+def test_randomized_env(n=3):
+    from functools import partial
+    from .backends import StubUnityEnv
+    from .envs import Car_v0
+    for prefetch in (0, 2):
+        configs = [dict(city_seed=0), dict(city_seed=1), dict(city_seed=1, width=128)]  # the last one repeats
+        env = RandomizedEnv(partial(Car_v0, backend=StubUnityEnv), n, prefetch,
+                            config_fn=lambda: configs.pop(0) if len(configs) > 1 else configs[0])
+        try:
+            first = env.env
+            for reconfigs, swaps, width in ((0, 0, 256), (1, 0, 256), (1, 1, 128)):
+                ob = env.reset()
+                assert (env.reconfigs, env.swaps) == (reconfigs, swaps) and ob["rgb"].shape[1] == width
+                assert (env.env is first) == (swaps == 0)  # a new city_seed is applied in place, a new width isn't
+                for _ in range(n + 1):
+                    env.step(env.action_space.sample())
+        finally:
+            closing = list(env._closing)
+            env.close()
+        assert (len(closing) == 1) == (prefetch > 0) and not any(t.is_alive() for t in closing)
 
-class ConcatComplex(gym.ObservationWrapper):
-    def __init__(self, env, observation_dict):
-        """observation_dict is a dict of lists of keys to be concatenated
+
+def test_prefetch(n=5, k=2, launch_time=0.3):
+    from .backends import StubUnityEnv
+    from .envs import Car_v0
+
+    def slow_launch():
+        time.sleep(launch_time)
+        return Car_v0({}, backend=StubUnityEnv)
+
+    for prefetch in (0, k):
+        env = RandomizedEnv(slow_launch, n, prefetch)
+        try:
+            env.reset()
+            first = env.env
+            for t in range(1, n + 2):
+                env.step(env.action_space.sample())
+                assert (env._next is not None) == (prefetch > 0 and t >= n - prefetch)  # launching in the background
+                if t == n:
+                    env.reset()  # not yet, the swap happens at the first reset after more than n steps
+                    assert env.env is first and not env.swaps
+            time.sleep(2 * launch_time)  # the rollout continues while the next env launches
+            env.reset()
+            assert env.env is not first and env.swaps == 1 and len(env.swap_latencies) == 1
+            assert (env.swap_latencies[0] < launch_time) == (prefetch > 0)
+        finally:
+            env.close()
+
+
+class Concatenation:
+    """Concatenates the arrays under `keys` (in that order) along their last axis into arrays described by
+    `concat_spaces_from_dict(spaces, keys)`. The plan (output size and slices) is computed once. Works on single and on
+    batched observations (with leading batch axes).
+
+    A single key is returned as is, without a copy. With `reuse_buffer` the output is written into the same array every
+    time (per shape), i.e. it is only valid until the next call.
+    """
+    def __init__(self, spaces: dict, keys, reuse_buffer=False):
+        self.keys = tuple(keys)
+        self.space = concat_spaces_from_dict(spaces, self.keys)
+        self.single = self.keys[0] if len(self.keys) == 1 else None
+        ends = np.cumsum([spaces[k].shape[-1] for k in self.keys])
+        self.slices = [(k, slice(end - spaces[k].shape[-1], end)) for k, end in zip(self.keys, ends)]
+        self.reuse_buffer = reuse_buffer
+        self.buffer = None
+
+    def __call__(self, d):
+        if self.single is not None:
+            return d[self.single]
+        shape = d[self.keys[0]].shape[:-1] + self.space.shape[-1:]
+        out = self.buffer
+        if out is None or out.shape != shape:
+            out = np.empty(shape, self.space.dtype)
+            if self.reuse_buffer:
+                self.buffer = out
+        for k, s in self.slices:
+            out[..., s] = d[k]
+        return out
+
+
+def test_concatenation():
+    import avenue
+    from .backends import StubUnityEnv
+    from .bench import env_layers
+    spaces = dict(a=gym.spaces.Box(-1, 1, (2,), np.float32), b=gym.spaces.Box(-1, 1, (3,), np.float32))
+    d = dict(a=np.array([1, 2], np.float32), b=np.array([3, 4, 5], np.float32))
+    batch = {k: np.stack([v, -v]) for k, v in d.items()}
+    for reuse_buffer in (False, True):
+        concat = Concatenation(spaces, ("b", "a"), reuse_buffer)  # not in the order of the dict
+        assert concat.space.shape == (5,)
+        out = concat(d)
+        assert np.array_equal(out, [3, 4, 5, 1, 2])
+        assert (concat(d) is out) == reuse_buffer
+        out = concat(batch)  # a new shape replaces the buffer
+        assert np.array_equal(out, [[3, 4, 5, 1, 2], [-3, -4, -5, -1, -2]])
+        assert (concat(batch) is out) == reuse_buffer
+    assert Concatenation(spaces, ("a",))(d) is d["a"]
+
+    for reuse_buffers in (False, True):  # DictToTupleWrapper in make_env
+        env = avenue.make("RaceSolo-v0", backend=StubUnityEnv, reuse_buffers=reuse_buffers)
+        try:
+            vector = env.reset()[1]
+            ob, _, _, _ = env.step(env.action_space.sample())
+            s = env_layers(env)[-1].state  # Car_v0
+            assert np.array_equal(ob[1], [s.velocity_magnitude[0] / 50, s.steering_angle[0]])  # the requested order
+            assert (ob[1] is vector) == reuse_buffers
+        finally:
+            env.close()
+
+
+class ConcatComplex(AsyncObservationWrapper):
+    def __init__(self, env, observation_dict, reuse_buffers=False):
+        """observation_dict is a dict of lists of keys to be concatenated (see Concatenation for `reuse_buffers`)
         """
         super().__init__(env)
         self.observation_dict = observation_dict
-        spaces = {k: concat_spaces_from_dict(env.observation_space.spaces, v) for k, v in observation_dict.items()}
-        self.observation_space = gym.spaces.Dict(spaces)
+        self.concatenations = {k: Concatenation(env.observation_space.spaces, v, reuse_buffers)
+                               for k, v in observation_dict.items()}
+        self.observation_space = gym.spaces.Dict({k: c.space for k, c in self.concatenations.items()})
 
     def observation(self, state):
-        return {k: np.concatenate([x for name, x in state.items() if name in v], axis=-1) for k, v in self.observation_dict.items()}
+        return {k: c(state) for k, c in self.concatenations.items()}
+
+    observation_batch = observation  # for dicts of batched arrays, e.g. from VecAvenue
 
 
-class DictToTupleWrapper(gym.ObservationWrapper):
-    def __init__(self, env, *args):
-        """Each argument contains a key or tuple of keys which will be concatenated"""
+class DictToTupleWrapper(AsyncObservationWrapper):
+    def __init__(self, env, *args, reuse_buffers=False):
+        """Each argument contains a key or tuple of keys which will be concatenated (see Concatenation for
+        `reuse_buffers`)"""
         super().__init__(env)
         self.keys = [k if isinstance(k, (list, tuple)) else (k,) for k in args]
         assert isinstance(env.observation_space, gym.spaces.Dict)
-        spaces = [concat_spaces_from_dict(env.observation_space.spaces, k) for k in self.keys]
-        self.observation_space = gym.spaces.Tuple(spaces)
+        self.concatenations = [Concatenation(env.observation_space.spaces, k, reuse_buffers) for k in self.keys]
+        self.observation_space = gym.spaces.Tuple([c.space for c in self.concatenations])
 
     def observation(self, state):
-        return tuple(np.concatenate([x for name, x in state.items() if name in k], axis=-1) for k in self.keys)
+        return tuple(c(state) for c in self.concatenations)
+
+    observation_batch = observation  # for dicts of batched arrays, e.g. from VecAvenue
 
 
 def concat_spaces_from_dict(spaces: dict, keys):
     """Used in ConcatComplex and DictToTupleWrapper"""
     assert all(name in spaces.keys() for name in keys), f"All values in {keys} must be in {spaces.keys()}"
-    shapes, lows, highs, dtypes = zip(*[(box.shape, box.low, box.high, box.dtype) for name, box in spaces.items() if name in keys])
+    shapes, lows, highs, dtypes = zip(*[(spaces[name].shape, spaces[name].low, spaces[name].high, spaces[name].dtype)
+                                        for name in keys])
     low = lows[0].flatten()[0]
     high = highs[0].flatten()[0]
     shapes_dim = [s[:-1] for s in shapes]
@@ -69,7 +307,7 @@ def concat_spaces_from_dict(spaces: dict, keys):
     return gym.spaces.Box(low=low, high=high, dtype=dtypes[0], shape=new_shape)
 
 
-class DifferentialActions(gym.ObservationWrapper):
+class DifferentialActions(AsyncObservationWrapper):
     action = None
 
     def __init__(self, env, alpha=0.1, key_to_concat="vector"):
@@ -87,40 +325,374 @@ class DifferentialActions(gym.ObservationWrapper):
         self.action = np.zeros(self.action_space.shape, np.float32)
         return super().reset(**kwargs)
 
-    def step(self, action):
+    def step_async(self, action, block=False):
         da = self.alpha * np.asarray(action, dtype=np.float32)
         self.action = (1-self.alpha) * self.action + da
         self.action = np.clip(self.action, -1, 1)
-        return super().step(self.action)
+        return self.env.step_async(self.action, block)
 
-class VideoSaver(gym.Wrapper):
+class VideoSaver(AsyncWrapper):
+    """Streams `ob[key]` to a video per episode, encoded in a background thread (see `avenue.recording.VideoEncoder`).
 
-    def __init__(self, env):
+    With `directory` every episode is saved as `episode_000000.<format>`, ... in it. Otherwise episodes are discarded on
+    `reset` unless `save_video` is called before. If the encoder falls behind, frames are dropped (`drop=True`) or the
+    rollout waits for it (`drop=False`).
+    """
+    def __init__(self, env, directory=None, format="mp4", fps=20, max_queue=64, drop=True, key="rgb"):
         gym.Wrapper.__init__(self, env)
-        self._env = self.env
-        self.video_buffer = deque(maxlen=10000)
+        from .recording import VideoEncoder
+        self.encoder = VideoEncoder(fps, max_queue, drop)
+        self.directory = directory
+        self.format = format
+        self.key = key
+        self.episodes = 0
+        self.recording = False
 
     def reset(self, **kwargs):
-        self.video_buffer.clear()
         ob = self.env.reset(**kwargs)
+        if self.recording:
+            self.encoder.finish(None if self.directory else False)
+        if self.directory:
+            path = os.path.join(self.directory, f"episode_{self.episodes:06d}.{self.format}")
+        else:
+            path = os.path.join(tempfile.gettempdir(), f"avenue_video_{os.getpid()}_{id(self)}.{self.format}")
+        self.episodes += 1
+        self.encoder.open(path)
+        self.recording = True
+        self.encoder.write(np.array(ob[self.key]))
         return ob
 
-    def save_video(self, path="/tmp/gif_avenue.gif"):
-        imageio.mimsave(path, self.video_buffer)
-        os.chmod(path, 0o777)  # TODO: is that really necessary?
+    def save_video(self, path=None):
+        """Saves the current episode (up to now) at `path` once it is encoded, without waiting for it. `path` needs
+        the same extension as `format`."""
+        path = path or f"/tmp/avenue.{self.format}"
+        assert path.endswith("." + self.format), f"{path} is not a .{self.format} file"
+        if self.recording:
+            self.encoder.finish(path)
+            self.recording = False
 
-    def step(self, action):
-        ob, reward, done, info = self.env.step(action)
-        self.video_buffer.append((ob["visual"]))
+    def step_wait(self):
+        ob, reward, done, info = self.env.step_wait()
+        if self.recording:
+            self.encoder.write(np.array(ob[self.key]))  # copies, ob might be a reused buffer
+        return ob, reward, done, info
+
+    def close(self):
+        if self.recording:
+            self.encoder.finish(None if self.directory else False)
+            self.recording = False
+        self.encoder.close()
+        return self.env.close()
+
+
+class RealTimeEnv(AsyncWrapper):
+    """Advances `env` at a fixed wall-clock `rate` (steps per second) in a background thread instead of waiting for the
+    agent. Every tick applies the most recent action, or holds the previous one (zeros after a reset) if the agent
+    hasn't sent a new one in time. `step` returns once the tick applying its action is done, with the rewards of all
+    ticks since the previous `step` summed up and in `info`:
+
+        "ticks": simulator steps since the previous `step`
+        "missed_deadlines": how many of them held the previous action because the agent was late
+        "action_latency": seconds from the previous observation being returned to the action arriving
+        "tick_jitter": the largest delay (seconds) of a tick relative to its scheduled time
+        "overruns": ticks skipped because the simulator step took longer than the period
+
+    Ticking stops when an episode is done and restarts with `reset`.
+    """
+    def __init__(self, env, rate=20.):
+        super().__init__(env)
+        self.period = 1 / rate
+        self.cond = threading.Condition()
+        self.thread = None
+        self.running = False
+        self.pending = self.transition = None
+        self.zero_action = np.zeros(self.action_space.shape, self.action_space.dtype)
+
+    def reset(self, **kwargs):
+        self.pause()
+        ob = self.env.reset(**kwargs)
+        self.action, self.held, self.pending = None, self.zero_action, None
+        self.transition = ob, 0., False, {}
+        self.ticks = self.missed = self.overruns = 0
+        self.jitter = 0.
+        self.delivered = time.perf_counter()
+        self.running = True
+        self.thread = threading.Thread(target=self.tick_loop, daemon=True)
+        self.thread.start()
+        return ob
+
+    def pause(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+            if self.pending is not None:  # e.g. reset before step_wait, the action won't be applied
+                self.pending.set_result(None)
+                self.pending = self.action = None
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def tick_loop(self):
+        deadline = time.perf_counter() + self.period
+        while True:
+            with self.cond:
+                while self.running and deadline - time.perf_counter() > 0:
+                    self.cond.wait(deadline - time.perf_counter())
+                if not self.running:
+                    return
+                jitter = time.perf_counter() - deadline
+                action, pending, self.action, self.pending = self.action, self.pending, None, None
+                missed = action is None
+                self.held = action = self.held if missed else action
+            ob, r, done, info = self.env.step(action)
+            with self.cond:
+                self.transition = ob, self.transition[1] + r, done, info
+                self.ticks += 1
+                self.missed += missed
+                self.jitter = max(self.jitter, jitter)
+                if done:
+                    self.running = False
+                    pending = pending or self.pending  # the episode ended before the agent's action was applied
+                    self.pending = None
+                if pending is not None:
+                    pending.set_result(None)
+                if done:
+                    return
+            deadline += self.period
+            late = time.perf_counter() - deadline
+            if late > 0:  # keep to the schedule, skipping the ticks we are too late for
+                skipped = int(late // self.period) + 1
+                deadline += skipped * self.period
+                with self.cond:
+                    self.overruns += skipped
+
+    def step_async(self, action, block=False):
+        with self.cond:
+            assert self.transition is not None, "reset has to be called before step_async"
+            assert self.pending is None, "step_wait has to be called before the next step_async"
+            self.latency = time.perf_counter() - self.delivered
+            self.action = action
+            self.future = self.pending = Future()
+            if not self.running:  # the episode is over, the action won't be applied
+                self.pending, self.action = None, None
+                self.future.set_result(None)
+            return self.future
+
+    def step_wait(self):
+        self.future.result()
+        with self.cond:
+            ob, reward, done, info = self.transition
+            info = dict(info, ticks=self.ticks, missed_deadlines=self.missed, action_latency=self.latency,
+                        tick_jitter=self.jitter, overruns=self.overruns)
+            stats.count("missed_deadlines", self.missed)
+            self.transition = ob, 0., done, info
+            self.ticks = self.missed = self.overruns = 0
+            self.jitter = 0.
+            self.delivered = time.perf_counter()
         return ob, reward, done, info
 
+    def close(self):
+        self.pause()
+        return self.env.close()
+
 
-class WrapPyTorch(gym.ObservationWrapper):
-    def __init__(self, env=None):
-        super(WrapPyTorch, self).__init__(env)
-        obs_shape = self.observation_space.spaces["visual"].shape
-        new_shape = (obs_shape[2], obs_shape[1], obs_shape[0])
-        self.observation_space = gym.spaces.Box(low=0, high=1, shape=new_shape, dtype=np.float32)
+def test_real_time(rate=50.):
+    import avenue
+    from .backends import StubUnityEnv
+    env = RealTimeEnv(avenue.make("RaceSolo-v0", backend=StubUnityEnv), rate)
+    a = env.action_space.sample()
+    try:
+        try:
+            env.step_async(a)
+        except AssertionError:
+            pass
+        else:
+            raise AssertionError("step_async before reset should fail")
+        env.reset()
+        _, _, _, info = env.step(a)  # the action arrives before the first tick
+        assert info["ticks"] == 1 and info["missed_deadlines"] == 0
+        time.sleep(5 / rate)
+        _, _, _, info = env.step(a)  # the ticks while we were sleeping hold the previous action
+        assert info["ticks"] >= 3 and info["missed_deadlines"] == info["ticks"] - 1
+
+        future = env.step_async(a)
+        env.reset()  # with a step pending
+        assert future.done()
+        _, _, _, info = env.step(a)
+        assert info["ticks"] == 1 and info["missed_deadlines"] == 0
+    finally:
+        env.close()
+
+
+class TrajectoryRecorder(AsyncWrapper):
+    """Streams observations, actions, rewards, done and reset flags and the flat vector state to a recording on disk
+    (see `avenue.recording`), e.g. `Recording(path)[i]["obs_0"]`. The first row of each episode (from `reset`) has
+    `first=True`, a zero action and zero reward."""
+    def __init__(self, env, path, chunk_size=1000):
+        super().__init__(env)
+        from .recording import ChunkWriter
+        self.writer = ChunkWriter(path, chunk_size)
+        self.zero_action = np.zeros(self.action_space.shape, np.float32)
+
+    def record(self, ob, action, reward, done, reset, first, state):
+        from .recording import flatten_obs
+        row = dict(flatten_obs(ob), action=action, reward=np.float32(reward), done=done, reset=reset, first=first)
+        if state is not None:
+            row["state"] = np.concatenate(state) if isinstance(state, tuple) else state
+        self.writer.append(row)
+
+    def reset(self, **kwargs):
+        ob = self.env.reset(**kwargs)
+        self.record(ob, self.zero_action, 0, False, False, True, getattr(self.env, "state", None))
+        return ob
+
+    def step_async(self, action, block=False):
+        self.action = np.asarray(action, np.float32)
+        return self.env.step_async(action, block)
+
+    def step_wait(self):
+        ob, reward, done, info = self.env.step_wait()
+        self.record(ob, self.action, reward, done, info.get("reset", False), False, info.get("avenue_state"))
+        return ob, reward, done, info
+
+    def close(self):
+        self.writer.close()
+        return self.env.close()
+
+
+class Preprocess(AsyncObservationWrapper):
+    """Turns the image `observation[key]` (`key` is a dict key, a tuple index or None for the whole observation) of
+    shape (height, width, channels) and dtype uint8 into a channel-first array of `dtype` in [0, 1], in one pass:
+
+        `crop`: (top, bottom, left, right) pixel bounds, applied first
+        `size`: (height, width), nearest neighbour resize
+        `gray`: convert to a single luma channel
+        `stack`: stack the last `stack` frames along the channel axis (oldest first), after a reset all of them are
+            the first frame
+
+    The result is written into preallocated buffers and only valid until the next step (or reset) unless `copy` is set.
+    Stacked frames are kept in a ring buffer of 2 * `stack` frames in which each frame is stored twice so that the
+    last `stack` frames are always a contiguous view. To only send preprocessed frames between processes run it in
+    the workers, e.g. `avenue.make_vec(..., wrappers=[partial(Preprocess, key=0, size=(84, 84))])`.
+    """
+    def __init__(self, env, key="rgb", dtype=np.float32, crop=None, size=None, gray=False, stack=1, copy=False):
+        super().__init__(env)
+        self.key = key
+        self.copy = copy
+        self.stack = stack
+        space = self.get(env.observation_space.spaces if key is not None else env.observation_space)
+        h, w, c = space.shape
+        top, bottom, left, right = crop or (0, h, 0, w)
+        self.size = size or (bottom - top, right - left)
+        if size is None:  # a view suffices
+            self.rows = self.cols = None
+            self.crop = slice(top, bottom), slice(left, right)
+        else:
+            self.rows = np.arange(self.size[0]) * (bottom - top) // self.size[0] + top
+            self.cols = np.arange(self.size[1]) * (right - left) // self.size[1] + left
+        self.gray_weights = (GRAY_WEIGHTS / 255).astype(np.float32) if gray and c == 3 else None
+        self.channels = 1 if self.gray_weights is not None else c
+        if self.gray_weights is not None and np.dtype(dtype) != np.float32:  # matmul can't write float16 directly
+            self.luma = np.empty(self.size, np.float32)
+        self.scale = np.float32(1 / 255)
+        # a lookup table is faster than arithmetic in (or casting to) float16
+        self.lut = None if np.dtype(dtype) == np.float32 else (np.arange(256) / 255).astype(dtype)
+        self.frames = np.zeros((2 * stack, self.channels) + self.size, dtype)
+        self.pos = 0
+        self.space = gym.spaces.Box(0, 1, (stack * self.channels,) + self.size, dtype)
+        self.observation_space = self.put(env.observation_space, self.space)
+
+    def get(self, ob):
+        return ob if self.key is None else ob[self.key]
+
+    def put(self, ob, x):
+        """`ob` with `x` at `key`"""
+        if self.key is None:
+            return x
+        if isinstance(ob, gym.spaces.Tuple):
+            return gym.spaces.Tuple(self.put(ob.spaces, x))
+        if isinstance(ob, gym.spaces.Dict):
+            return gym.spaces.Dict(self.put(ob.spaces, x))
+        if isinstance(ob, tuple):
+            return ob[:self.key] + (x,) + ob[self.key + 1:]
+        return dict(ob, **{self.key: x})
+
+    def process(self, frame, out):
+        """Writes the preprocessed `frame` into `out` of shape (channels, height, width)"""
+        src = frame[self.crop] if self.rows is None else frame[self.rows[:, None], self.cols]
+        if self.gray_weights is not None:
+            if out.dtype == np.float32:
+                np.matmul(src, self.gray_weights, out=out[0])
+            else:
+                np.matmul(src, self.gray_weights, out=self.luma)
+                np.copyto(out[0], self.luma, casting='unsafe')
+        elif self.lut is not None:
+            np.take(self.lut, src.transpose(2, 0, 1), out=out)
+        else:
+            np.multiply(src.transpose(2, 0, 1), self.scale, out=out, casting='unsafe')
 
     def observation(self, observation):
-        return observation.transpose(2, 0, 1)/255
+        k = self.stack
+        self.process(self.get(observation), self.frames[self.pos + k])
+        if k > 1:
+            self.frames[self.pos] = self.frames[self.pos + k]
+        x = self.frames[self.pos + 1:self.pos + 1 + k].reshape(self.space.shape)
+        self.pos = (self.pos + 1) % k
+        return self.put(observation, x.copy() if self.copy else x)
+
+    def reset(self, **kwargs):
+        observation = self.env.reset(**kwargs)
+        self.process(self.get(observation), self.frames[0])
+        self.frames[:] = self.frames[0]
+        self.pos = 0
+        x = self.frames[1:1 + self.stack].reshape(self.space.shape)
+        return self.put(observation, x.copy() if self.copy else x)
+
+
+def test_preprocess(k=3, steps=10):
+    from functools import partial
+    import avenue
+    from .backends import StubUnityEnv
+    from .bench import env_layers
+    from .util import to_uint8
+    env = avenue.make("RaceSolo-v0", backend=StubUnityEnv, wrappers=[partial(Preprocess, key=0, stack=k)])
+
+    def frame(t):  # the uint8 frame at step t of an episode
+        stub = env_layers(env)[-1].env
+        return to_uint8(stub.frames[t % len(stub.frames)][0])
+
+    try:
+        for _ in range(2):  # the second reset happens in the middle of the ring buffer
+            ob = env.reset()
+            for t in range(steps):  # wraps around the ring buffer several times
+                stacked = ob[0].reshape((k, 3) + frame(t).shape[:2])
+                for i in range(k):  # oldest first, the first frame repeated right after a reset
+                    assert np.array_equal(stacked[i], frame(max(t - k + 1 + i, 0)).transpose(2, 0, 1) * np.float32(1 / 255))
+                ob, _, _, _ = env.step(env.action_space.sample())
+    finally:
+        env.close()
+
+    for dtype in (np.float32, np.float16):
+        env = avenue.make("RaceSolo-v0", backend=StubUnityEnv, wrappers=[partial(Preprocess, key=0, gray=True,
+                                                                                 size=(32, 64), dtype=dtype)])
+        try:
+            ob = env.reset()
+            expected = frame(0)[::2, ::4] @ GRAY_WEIGHTS / 255
+            assert ob[0].shape == (1, 32, 64) and ob[0].dtype == dtype
+            assert np.allclose(ob[0][0], expected, atol=1e-3 if dtype == np.float16 else 1e-6)
+        finally:
+            env.close()
+
+
+class WrapPyTorch(Preprocess):
+    """Channel-first float32 rgb in [0, 1]"""
+    def __init__(self, env=None, key="rgb"):
+        super().__init__(env, key)
+
+
+if __name__ == "__main__":
+    test_concatenation()
+    test_prefetch()
+    test_randomized_env()
+    test_real_time()
+    test_preprocess()
@@ -17,5 +17,8 @@ setup(name='avenue',
             "mlagents @ git+https://git@github.com/rmst/ml-agents-frozen@fd10e3544472b365701da2526a8262e0c8a15784#egg=mlagents",
       ],
       extras_require={},
+      entry_points={"console_scripts": ["avenue-bench=avenue.bench:main",
+                                        "avenue-dataset=avenue.dataset:main",
+                                        "avenue-server=avenue.remote:main"]},
       packages=find_packages()
 )